@@ -31,7 +31,7 @@ if __name__ == '__main__':
     course = MoodleCourse.from_course_id(conn, args.courseid)
 
     for assignment in course.assignments():
-        for submission in assignment.submissions():
+        for submission in assignment.iter_submissions(prefetch=4):
             print(submission)
             for f in submission.files:
                 print(f)
@@ -27,7 +27,8 @@ sys.path.append(os.path.realpath('.'))
 
 from moodleteacher.connection import MoodleConnection      # NOQA
 from moodleteacher.courses import MoodleCourse             # NOQA
-from moodleteacher.jobs import ValidationJob               # NOQA
+from moodleteacher.validation import Job, ValidationPool  # NOQA
+from moodleteacher.results import ResultStore              # NOQA
 
 # Enable library debug logging on screen
 handler = logging.StreamHandler(sys.stdout)
@@ -58,7 +59,11 @@ if __name__ == "__main__":
             validators_folder = folder
             print("Folder: {0}".format(validators_folder))
 
+    # Unchanged submissions are not validated again, and get no duplicate feedback
+    result_store = ResultStore(repost_identical=False)
+
     # Scan validator files in folder, determine according assignment and check if it has submissions
+    jobs = []
     for validator in validators_folder.files:
         validator_assignment_name = validator.name.split('.')[0]
         for assignment in assignments:
@@ -67,5 +72,9 @@ if __name__ == "__main__":
                 print("Assignment {0} with {1} submissions.".format(assignment, len(submissions)))
                 for submission in submissions:
                     print("Submission to be validated: {0}".format(submission))
-                    job = ValidationJob(submission, validator)
-                    job.start(log_level=logging.INFO)
+                    jobs.append(Job(submission, validator, "Automated validation result:\n\n",
+                                    result_store=result_store))
+
+    # Run the validation jobs in parallel, one worker process per CPU core
+    for result in ValidationPool(log_level=logging.INFO).run(jobs):
+        print(result)
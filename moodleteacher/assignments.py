@@ -2,7 +2,9 @@
 Functionality dealing with Moodle assignments.
 """
 
+import collections
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from .submissions import MoodleSubmission
 from .requests import MoodleRequest
@@ -17,7 +19,7 @@ class MoodleAssignment():
         A single Moodle assignment.
     """
 
-    def __init__(self, course, assignment_id, course_module_id=None, duedate=None, cutoffdate=None, deadline=None, name=None, allows_feedback_comment=None):
+    def __init__(self, course, assignment_id, course_module_id=None, duedate=None, cutoffdate=None, deadline=None, name=None, allows_feedback_comment=None, teamsubmission=False):
         self.conn = course.conn
         self.course = course
         self.id_ = assignment_id
@@ -27,6 +29,7 @@ class MoodleAssignment():
         self.deadline = deadline
         self.name = name
         self.allows_feedback_comment = allows_feedback_comment
+        self.teamsubmission = teamsubmission
 
     @classmethod
     def from_raw_json(cls, course, raw_json):
@@ -50,7 +53,8 @@ class MoodleAssignment():
                    cutoffdate=cutoffdate,
                    deadline=cutoffdate if duedate < cutoffdate else duedate,
                    name=raw_json['name'],
-                   allows_feedback_comment=allows_feedback_comment)
+                   allows_feedback_comment=allows_feedback_comment,
+                   teamsubmission=bool(raw_json.get('teamsubmission', False)))
 
     @classmethod
     def from_assignment_id(cls, course, assignment_id):
@@ -113,18 +117,25 @@ class MoodleAssignment():
             logger.error("Could not fetch submission information:")
             logger.exception(e)
             return None
+        result = self._submission_from_status(response, must_have_files)
+        if result is None:
+            return None
+        submission, plugins = result
+        submission.parse_plugin_json(plugins)
+        return submission
+
+    def _submission_from_status(self, response, must_have_files=False):
+        """
+        Create a :class:`MoodleSubmission` object from a mod_assign_get_submission_status
+        response, without fetching its files.
+
+        Returns:
+            tuple: The submission and its plugin JSON block, or None.
+        """
         if 'lastattempt' in response:
             if 'submission' in response['lastattempt']:
-                if must_have_files:
-                    plugin_list = response['lastattempt']['submission']['plugins']
-                    for plugin_data in plugin_list:
-                        if plugin_data['type'] == 'file' and len(plugin_data['fileareas'][0]['files']) == 0:
-                            # Submission with no files
-                            # We had that effect of ghost submissions, were people never
-                            # even watched the assignment and still got submissions registered
-                            # This is the safeguard to protect from that
-                            logger.error('Submission with empty file list, ignoring it.')
-                            return None
+                if must_have_files and self._lacks_files(response['lastattempt']['submission']['plugins']):
+                    return None
 
                 submission = MoodleSubmission(
                     conn=self.conn,
@@ -135,35 +146,124 @@ class MoodleAssignment():
                 if 'teamsubmission' in response['lastattempt']:
                     logger.debug("Identified team submission.")
                     submission.group_id = response['lastattempt']['teamsubmission']['groupid']
-                    submission.parse_plugin_json(response['lastattempt']['teamsubmission']['plugins'])
+                    return submission, response['lastattempt']['teamsubmission']['plugins']
                 else:
                     logger.debug("Identified single submission.")
-                    submission.parse_plugin_json(response['lastattempt']['submission']['plugins'])
-                return submission
+                    return submission, response['lastattempt']['submission']['plugins']
         return None
 
-    def submissions(self, must_have_files=False):
+    @staticmethod
+    def _lacks_files(plugin_list):
         """
-        Get a list of :class:`MoodleSubmission` objects for this assignment.
+        Checks if the plugin block of a submission contains an empty file list.
+        """
+        for plugin_data in plugin_list:
+            if plugin_data['type'] == 'file' and len(plugin_data['fileareas'][0]['files']) == 0:
+                # Submission with no files
+                # We had that effect of ghost submissions, were people never
+                # even watched the assignment and still got submissions registered
+                # This is the safeguard to protect from that
+                logger.error('Submission with empty file list, ignoring it.')
+                return True
+        return False
+
+    def _needs_status_lookup(self, subm_data):
+        """
+        Checks if an entry from the mod_assign_get_submissions response
+        lacks information that only mod_assign_get_submission_status provides.
+        """
+        # On group submissions, the submission details fetched with the
+        # first API call are incomplete.
+        return self.teamsubmission or subm_data.get('groupid', 0) != 0 or 'plugins' not in subm_data
+
+    def _submission_from_bulk(self, subm_data, must_have_files=False):
+        """
+        Create a :class:`MoodleSubmission` object from an entry of the
+        mod_assign_get_submissions response, without fetching its files.
+
+        Returns:
+            tuple: The submission and its plugin JSON block, or None.
+        """
+        if must_have_files and self._lacks_files(subm_data['plugins']):
+            return None
+        submission = MoodleSubmission(
+            conn=self.conn,
+            submission_id=subm_data['id'],
+            assignment=self,
+            user_id=subm_data['userid'],
+            status=subm_data.get('status'),
+            gradingstatus=subm_data.get('gradingstatus'))
+        return submission, subm_data['plugins']
+
+    def _build_submission(self, subm_data, must_have_files=False, fetch_files=False):
+        if self._needs_status_lookup(subm_data):
+            submission = self.get_user_submission(subm_data['userid'], must_have_files)
+        else:
+            result = self._submission_from_bulk(subm_data, must_have_files)
+            if result is None:
+                return None
+            submission, plugins = result
+            submission.parse_plugin_json(plugins)
+        if submission is not None and fetch_files:
+            submission.prefetch()
+        return submission
+
+    def _bulk_submission_data(self):
+        """
+        Fetch the overview list of submissions for this assignment.
         """
-        result = []
-        # First, fetch the overview list of submissions for this assignment.
         params = {'assignmentids[0]': self.id_}
         response = MoodleRequest(
             self.conn, 'mod_assign_get_submissions').post(params).json()
+        result = []
         if 'assignments' in response:
             for response_assignment in response['assignments']:
                 assert(response_assignment['assignmentid'] == self.id_)
-                for subm_data in response_assignment['submissions']:
-                    # On group submissions, the submission details fetch with the
-                    # first API call are incomplete.
-                    # We therefore query each identified
-                    # submission with a separate API call.
-                    sub = self.get_user_submission(subm_data['userid'], must_have_files)
-                    if sub is not None:
-                        result.append(sub)
+                result.extend(response_assignment['submissions'])
         return result
 
+    def submissions(self, must_have_files=False, max_workers=8, fetch_files=False):
+        """
+        Get a list of :class:`MoodleSubmission` objects for this assignment.
+
+        Submissions are created from a single bulk request. Only submissions with
+        incomplete information in this response, such as team submissions, are
+        fetched separately, using a pool of `max_workers` threads.
+
+        File contents are downloaded on first access, unless `fetch_files` is set.
+        """
+        return list(self.iter_submissions(must_have_files, prefetch=max_workers, fetch_files=fetch_files))
+
+    def iter_submissions(self, must_have_files=False, prefetch=4, fetch_files=True):
+        """
+        Iterate over the :class:`MoodleSubmission` objects for this assignment.
+
+        Each submission is yielded as soon as it is ready. While the caller deals with
+        it, the following `prefetch` submissions are fetched in the background,
+        including their file contents if `fetch_files` is set. Submissions are
+        yielded in the order of the Moodle response.
+        """
+        subm_list = self._bulk_submission_data()
+        lookups = sum(1 for subm_data in subm_list if self._needs_status_lookup(subm_data))
+        logger.debug("{0} submissions, {1} of them need a separate status request.".format(len(subm_list), lookups))
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=max(1, prefetch)) as executor:
+            try:
+                for subm_data in subm_list:
+                    pending.append(executor.submit(self._build_submission, subm_data, must_have_files, fetch_files))
+                    if len(pending) > prefetch:
+                        sub = pending.popleft().result()
+                        if sub is not None:
+                            yield sub
+                while pending:
+                    sub = pending.popleft().result()
+                    if sub is not None:
+                        yield sub
+            finally:
+                # Caller stopped the iteration early
+                for future in pending:
+                    future.cancel()
+
 
 class MoodleAssignments(list):
     """
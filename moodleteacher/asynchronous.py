@@ -0,0 +1,150 @@
+"""
+Asyncio interface for Moodle web service calls and file downloads.
+
+The blocking requests are sent through the pooled HTTP session
+of a :class:`MoodleConnection`, using a bounded thread pool. This allows
+to fetch all submissions of an assignment concurrently, so that
+the overall time is close to the time of the slowest request.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .requests import MoodleRequest
+from .files import MoodleFile
+from .submissions import MoodleSubmission
+
+import logging
+logger = logging.getLogger('moodleteacher')
+
+
+class AsyncMoodleConnection():
+    """
+    An asyncio wrapper for a :class:`MoodleConnection`.
+    """
+
+    def __init__(self, conn, max_concurrency=10):
+        """
+        Args:
+            conn (MoodleConnection): The connection used for all requests.
+            max_concurrency (int):   Maximum number of requests running at the same time.
+                                     Should not exceed the pool size of the connection.
+        """
+        self.conn = conn
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency,
+                                            thread_name_prefix='moodleteacher')
+
+    def __str__(self):
+        return "Asynchronous {0}".format(self.conn)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker threads, after all pending requests are finished.
+        """
+        self._executor.shutdown(wait=True)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the request thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def file_from_url(self, url, name=None, time_modified=None, mime_type=None):
+        """
+        Asynchronous version of :meth:`MoodleFile.from_url`.
+        """
+        moodle_file = MoodleFile.from_url(self.conn, url, name, time_modified, mime_type)
+        return await self.run(moodle_file.prefetch)
+
+    async def _fetch_files(self, submission, plugins):
+        fileinfos, textfield = MoodleSubmission._parse_plugins(plugins)
+        submission.files = list(await asyncio.gather(
+            *[self.file_from_url(url=fileinfo['fileurl'],
+                                 name=fileinfo['filename'],
+                                 time_modified=fileinfo['timemodified'],
+                                 mime_type=fileinfo['mimetype']) for fileinfo in fileinfos]))
+        submission.textfield = textfield
+        return submission
+
+    async def get_user_submission(self, assignment, user_id, must_have_files=False):
+        """
+        Asynchronous version of :meth:`MoodleAssignment.get_user_submission`.
+        """
+        params = {'assignid': assignment.id_, 'userid': user_id}
+        logger.debug("Fetching submission information for user {userid} in assignment {assignid}".format(**params))
+        try:
+            response = await AsyncMoodleRequest(self, 'mod_assign_get_submission_status').get(params)
+            response = response.json()
+        except Exception as e:
+            logger.error("Could not fetch submission information:")
+            logger.exception(e)
+            return None
+        result = assignment._submission_from_status(response, must_have_files)
+        if result is None:
+            return None
+        submission, plugins = result
+        return await self._fetch_files(submission, plugins)
+
+    async def _build_submission(self, assignment, subm_data, must_have_files):
+        if assignment._needs_status_lookup(subm_data):
+            return await self.get_user_submission(assignment, subm_data['userid'], must_have_files)
+        result = assignment._submission_from_bulk(subm_data, must_have_files)
+        if result is None:
+            return None
+        submission, plugins = result
+        return await self._fetch_files(submission, plugins)
+
+    async def submissions(self, assignment, must_have_files=False):
+        """
+        Asynchronous version of :meth:`MoodleAssignment.submissions`.
+        """
+        subm_list = await self.run(assignment._bulk_submission_data)
+        pending = [self._build_submission(assignment, subm_data, must_have_files) for subm_data in subm_list]
+        return [sub for sub in await asyncio.gather(*pending) if sub is not None]
+
+    async def save_grade(self, submission, grade, feedback=None):
+        """
+        Asynchronous version of :meth:`MoodleSubmission.save_grade`.
+        """
+        data = submission._grade_data(grade, feedback)
+        if data is None:
+            return
+        response = await AsyncMoodleRequest(self, 'mod_assign_save_grade').post(data=data)
+        logger.debug("Response from grading update: {0}".format(response.json()))
+        submission._update_grade_index(grade)
+
+
+class AsyncMoodleRequest():
+    """
+    An asynchronous Moodle web service API request.
+    """
+
+    def __init__(self, aconn, funcname):
+        """
+        Parameters:
+            aconn: The AsyncMoodleConnection object.
+            funcname: The name of the Moodle web service function.
+        """
+        self.aconn = aconn
+        self.request = MoodleRequest(aconn.conn, funcname)
+
+    async def get(self, params=None):
+        """
+        Perform a GET request to the Moodle web service API.
+        """
+        return await self.aconn.run(self.request.get, params)
+
+    async def post(self, params=None, data=None):
+        """
+        Perform a POST request to the Moodle web service API.
+        """
+        return await self.aconn.run(self.request.post, params, data)
@@ -0,0 +1,95 @@
+"""
+Timing statistics for repeated runs of student programs.
+"""
+
+import math
+import statistics
+
+
+class BenchmarkResult():
+    """
+    The resource usage of repeated runs of a program, see :meth:`Job.benchmark_program`.
+
+    Attributes:
+        name (str):               The benchmarked program.
+        runs (list):              The :class:`ResourceUsage` of each measured run, without warmup runs.
+        reference (BenchmarkResult): The result for the reference program, if any.
+        tolerance (float):        Allowed slowdown factor against the reference program.
+    """
+
+    # CPU times below this value are measurement noise, not algorithmic cost
+    MIN_TIME = 0.01
+
+    def __init__(self, name, runs, reference=None, tolerance=None):
+        self.name = name
+        self.runs = runs
+        self.reference = reference
+        self.tolerance = tolerance
+
+    def __str__(self):
+        text = "{0}: {1} runs, wall time min {2:.3f}s / median {3:.3f}s / p95 {4:.3f}s, CPU time {5:.3f}s, peak memory {6} KB".format(
+            self.name, len(self.runs), self.min, self.median, self.p95, self.cpu_time, self.max_rss // 1024)
+        if self.reference:
+            text += ", {0:.2f} times the reference".format(self.slowdown)
+        return text
+
+    @property
+    def wall_times(self):
+        return sorted(run.wall_time for run in self.runs)
+
+    @property
+    def min(self):
+        """Shortest wall time in seconds."""
+        return self.wall_times[0]
+
+    @property
+    def median(self):
+        """Median wall time in seconds."""
+        return statistics.median(self.wall_times)
+
+    @property
+    def p95(self):
+        """95th percentile of the wall times in seconds, by the nearest-rank method."""
+        times = self.wall_times
+        return times[max(math.ceil(0.95 * len(times)) - 1, 0)]
+
+    @property
+    def cpu_time(self):
+        """Median user and system CPU time in seconds."""
+        return statistics.median(run.cpu_time for run in self.runs)
+
+    @property
+    def max_rss(self):
+        """Largest peak memory of all runs in bytes."""
+        return max(run.max_rss for run in self.runs)
+
+    @property
+    def slowdown(self):
+        """
+        Median CPU time, relative to the reference program.
+        CPU time is used since it is less affected by other
+        jobs running in parallel than the wall time.
+        """
+        if not self.reference:
+            return None
+        return max(self.cpu_time, self.MIN_TIME) / max(self.reference.cpu_time, self.MIN_TIME)
+
+    @property
+    def acceptable(self):
+        """False if the program is slower than the reference by more than the tolerance factor."""
+        if not self.reference:
+            return True
+        return self.slowdown <= self.tolerance
+
+    def as_dict(self):
+        result = {'name': self.name,
+                  'runs': len(self.runs),
+                  'min': self.min,
+                  'median': self.median,
+                  'p95': self.p95,
+                  'cpu_time': self.cpu_time,
+                  'max_rss': self.max_rss}
+        if self.reference:
+            result['reference'] = self.reference.as_dict()
+            result['slowdown'] = self.slowdown
+        return result
@@ -0,0 +1,164 @@
+"""
+A local on-disk cache for file downloads from Moodle.
+"""
+
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import closing
+
+from . import storage
+
+import logging
+logger = logging.getLogger('moodleteacher')
+
+
+class DownloadCache():
+    """
+    A content-addressed cache for downloaded Moodle files.
+
+    Entries are looked up by the file URL and its modification time stamp,
+    as reported by Moodle. The file content is stored under its SHA-256 hash,
+    so identical files are only stored once. When the cache grows beyond
+    `max_size` bytes, the least recently used entries are evicted.
+
+    The cache is enabled by passing it to :class:`MoodleConnection`.
+
+    Attributes:
+        directory (str):  The cache directory.
+        max_size (int):   Maximum size of all cached file contents in bytes.
+        hits (int):       Number of successful lookups.
+        misses (int):     Number of lookups without a cache entry.
+        evictions (int):  Number of entries removed to stay below max_size.
+    """
+
+    def __init__(self, directory=None, max_size=1024 * 1024 * 1024):
+        if not directory:
+            directory = os.path.expanduser("~/.cache/moodleteacher/downloads")
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self._db_path = os.path.join(directory, 'index.sqlite')
+        with closing(self._connect()) as db, db:
+            db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                              key TEXT PRIMARY KEY,
+                              digest TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              content_type TEXT,
+                              encoding TEXT,
+                              last_access REAL NOT NULL)''')
+
+    def __str__(self):
+        return "Download cache in {directory}: {entries} entries, {size} bytes, {hits} hits, {misses} misses, {evictions} evictions".format(**self.stats())
+
+    def _connect(self):
+        return storage.connect(self._db_path)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    @staticmethod
+    def _key(url, time_modified):
+        return "{0}@{1}".format(url, time_modified)
+
+    def lookup(self, url, time_modified):
+        """
+        Find the cached content for a file.
+
+        Returns:
+            tuple: The path of the cached content, the content type and the encoding, or None.
+        """
+        key = self._key(url, time_modified)
+        with closing(self._connect()) as db, db:
+            row = db.execute('SELECT digest, content_type, encoding FROM entries WHERE key=?', (key,)).fetchone()
+            if row and os.path.exists(self._object_path(row[0])):
+                db.execute('UPDATE entries SET last_access=? WHERE key=?', (time.time(), key))
+                with self._lock:
+                    self.hits += 1
+                logger.debug("Download cache hit for {0}".format(url))
+                return self._object_path(row[0]), row[1], row[2]
+            if row:
+                # Content was removed from the disk
+                db.execute('DELETE FROM entries WHERE key=?', (key,))
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(self, url, time_modified, fileobj, content_type=None, encoding=None):
+        """
+        Add the content of a file object to the cache.
+
+        Returns:
+            str: The path of the cached content.
+        """
+        sha = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self.directory, 'objects'), delete=False) as tmp:
+            for chunk in iter(lambda: fileobj.read(64 * 1024), b''):
+                sha.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        digest = sha.hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            os.remove(tmp.name)
+        else:
+            os.replace(tmp.name, path)
+        with closing(self._connect()) as db, db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                       (self._key(url, time_modified), digest, size, content_type, encoding, time.time()))
+        logger.debug("Stored {0} in download cache as {1}".format(url, digest))
+        self._evict()
+        return path
+
+    def _evict(self):
+        with closing(self._connect()) as db, db:
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)').fetchone()[0]
+            if total <= self.max_size:
+                return
+            for key, digest, size in db.execute('SELECT key, digest, size FROM entries ORDER BY last_access').fetchall():
+                if total <= self.max_size:
+                    break
+                db.execute('DELETE FROM entries WHERE key=?', (key,))
+                with self._lock:
+                    self.evictions += 1
+                # Content may be shared with other entries
+                if db.execute('SELECT COUNT(*) FROM entries WHERE digest=?', (digest,)).fetchone()[0] == 0:
+                    try:
+                        os.remove(self._object_path(digest))
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                logger.debug("Evicted {0} from download cache".format(key))
+
+    def stats(self):
+        """
+        Returns:
+            dict: The cache directory, number of entries, cached bytes, and hit, miss and eviction counts.
+        """
+        with closing(self._connect()) as db:
+            entries = db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            size = db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM entries)').fetchone()[0]
+        return {'directory': self.directory,
+                'entries': entries,
+                'size': size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def clear(self):
+        """
+        Remove all cached content.
+        """
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM entries')
+        shutil.rmtree(os.path.join(self.directory, 'objects'), ignore_errors=True)
+        os.makedirs(os.path.join(self.directory, 'objects'), exist_ok=True)
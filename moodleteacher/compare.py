@@ -0,0 +1,159 @@
+"""
+Streaming comparison of program outputs.
+"""
+
+import io
+import math
+import re
+
+# Comparison modes
+EXACT = 'exact'
+WHITESPACE = 'whitespace'       # Ignore the amount and kind of whitespace between tokens
+NUMERIC = 'numeric'             # Like WHITESPACE, numbers may differ within a tolerance
+
+CHUNK_SIZE = 64 * 1024
+
+_TOKEN = re.compile(rb'\n|[^\s]+')
+# Separators of _TOKEN, the same as \s for bytes
+_WHITESPACE = [bytes([char]) for char in b' \t\n\r\x0b\x0c']
+
+
+class ComparisonResult():
+    """
+    The result of an output comparison, which is true if the outputs match.
+
+    Attributes:
+        line (int):       The line of the first difference, counted in the expected output.
+        expected (bytes): The expected text at the first difference, or None at the end of the output.
+        actual (bytes):   The actual text at the first difference, or None at the end of the output.
+    """
+
+    def __init__(self, line=None, expected=None, actual=None):
+        self.line = line
+        self.expected = expected
+        self.actual = actual
+
+    def __bool__(self):
+        return self.line is None
+
+    def __str__(self):
+        if self:
+            return "The output is correct."
+
+        def show(text):
+            if text is None:
+                return "end of output"
+            return repr(text.decode('utf-8', errors='replace'))
+        return "Line {0}: expected {1}, got {2}.".format(self.line, show(self.expected), show(self.actual))
+
+
+def _stream(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if isinstance(data, (bytes, bytearray)):
+        return io.BytesIO(data)
+    return data
+
+
+def _read_exactly(stream, size):
+    # Pipes and sockets may return less than requested
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _tokens(stream):
+    """
+    Yield the line number and the text of all whitespace-separated tokens.
+    """
+    line = 1
+    rest = bytearray()
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        # The last token may continue in the next chunk
+        split = max(chunk.rfind(char) for char in _WHITESPACE) + 1
+        if not split:
+            rest += chunk
+            continue
+        data = bytes(rest) + chunk[:split]
+        rest = bytearray(chunk[split:])
+        for match in _TOKEN.finditer(data):
+            if match.group() == b'\n':
+                line += 1
+            else:
+                yield line, match.group()
+    if rest:
+        yield line, bytes(rest)
+
+
+def _numbers_match(expected, actual, tolerance):
+    try:
+        expected_value, actual_value = float(expected), float(actual)
+    except ValueError:
+        return False
+    return math.isclose(expected_value, actual_value, rel_tol=tolerance, abs_tol=tolerance)
+
+
+def _compare_exact(expected, actual):
+    line = 1
+    while True:
+        expected_chunk = _read_exactly(expected, CHUNK_SIZE)
+        actual_chunk = _read_exactly(actual, CHUNK_SIZE)
+        if expected_chunk == actual_chunk:
+            if not expected_chunk:
+                return ComparisonResult()
+            line += expected_chunk.count(b'\n')
+            continue
+        offset = 0
+        while (offset < len(expected_chunk) and offset < len(actual_chunk)
+               and expected_chunk[offset] == actual_chunk[offset]):
+            offset += 1
+        line += expected_chunk.count(b'\n', 0, offset)
+        return ComparisonResult(line,
+                                expected_chunk[offset:].split(b'\n')[0] if offset < len(expected_chunk) else None,
+                                actual_chunk[offset:].split(b'\n')[0] if offset < len(actual_chunk) else None)
+
+
+def _compare_tokens(expected, actual, numeric, tolerance):
+    expected_tokens, actual_tokens = _tokens(expected), _tokens(actual)
+    line = 1
+    while True:
+        expected_token = next(expected_tokens, None)
+        actual_token = next(actual_tokens, None)
+        if expected_token is None and actual_token is None:
+            return ComparisonResult()
+        if expected_token:
+            line = expected_token[0]
+        if expected_token is None or actual_token is None:
+            return ComparisonResult(line,
+                                    expected_token[1] if expected_token else None,
+                                    actual_token[1] if actual_token else None)
+        if expected_token[1] == actual_token[1]:
+            continue
+        if numeric and _numbers_match(expected_token[1], actual_token[1], tolerance):
+            continue
+        return ComparisonResult(line, expected_token[1], actual_token[1])
+
+
+def compare(expected, actual, mode=EXACT, tolerance=1e-6):
+    """
+    Compare two outputs chunk by chunk, without reading them completely into memory.
+
+    Args:
+        expected:          The expected output, as bytes, text or binary file object.
+        actual:            The actual output, as bytes, text or binary file object.
+        mode (str):        EXACT, WHITESPACE or NUMERIC.
+        tolerance (float): Allowed absolute or relative difference of numbers in NUMERIC mode.
+
+    Returns:
+        ComparisonResult: The first difference, or a true value if the outputs match.
+    """
+    expected, actual = _stream(expected), _stream(actual)
+    if mode == EXACT:
+        return _compare_exact(expected, actual)
+    if mode in (WHITESPACE, NUMERIC):
+        return _compare_tokens(expected, actual, mode == NUMERIC, tolerance)
+    raise ValueError("Unknown comparison mode '{0}'.".format(mode))
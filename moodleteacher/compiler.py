@@ -2,7 +2,16 @@
 Functions dealing with the compilation of code.
 """
 
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
 from .exceptions import ValidatorBrokenException
+from . import storage
 
 import logging
 logger = logging.getLogger('moodleteacher')
@@ -11,6 +20,9 @@ GCC = ['gcc', '-o', '{output}', '{inputs}']
 GPP = ['g++', '-pthread', '-o', '{output}', '{inputs}']
 JAVAC = ['javac', '{inputs}']
 
+# Files that are included by translation units, instead of being compiled
+HEADER_EXTENSIONS = ('.h', '.hh', '.hpp', '.hxx', '.inc')
+
 
 def compiler_cmdline(compiler=GCC, output=None, inputs=None):
     """
@@ -32,7 +44,7 @@ def compiler_cmdline(compiler=GCC, output=None, inputs=None):
         elif element == '{inputs}':
             if inputs:
                 for fname in inputs:
-                    if compiler in [GCC, GPP] and fname.endswith('.h'):
+                    if compiler in [GCC, GPP] and fname.endswith(HEADER_EXTENSIONS):
                         logger.debug('Omitting {0} in the compiler call.'.format(fname))
                     else:
                         cmdline.append(fname)
@@ -42,3 +54,185 @@ def compiler_cmdline(compiler=GCC, output=None, inputs=None):
         else:
             cmdline.append(element)
     return cmdline[0], cmdline[1:]
+
+
+def object_cmdline(compiler, source, output):
+    """
+    Determine the command-line for compiling a single translation unit
+    into an object file. Only suitable for GCC and GPP.
+
+    Args:
+        compiler (tuple): A compiler definition.
+        source (str): The file path of the translation unit.
+        output (str): The file path for the object file.
+    """
+    compiler_cmd, compiler_args = compiler_cmdline(compiler=compiler, output=output, inputs=[source])
+    return compiler_cmd, ['-c'] + compiler_args
+
+
+def _snapshot(directory):
+    """
+    Determine size and modification time of all files in a directory tree.
+    """
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            info = os.stat(path)
+            result[os.path.relpath(path, directory)] = (info.st_size, info.st_mtime_ns)
+    return result
+
+
+class CompilerCache():
+    """
+    A local on-disk cache for compiler results.
+
+    Entries are identified by the compiler definition, the command-line arguments,
+    and the content of all files in the working directory before compilation.
+    An entry consists of all files that the compiler created or changed, such as
+    the output binary or the `.class` files from `javac`. Only successful compiler
+    runs are cached. When the cache has more than `max_entries` entries, the
+    least recently used ones are removed.
+
+    The cache is enabled by passing it to :class:`Job`.
+
+    Attributes:
+        directory (str):    The cache directory.
+        max_entries (int):  Maximum number of cached compiler runs.
+        hits (int):         Number of compiler runs that were restored from the cache.
+        misses (int):       Number of compiler runs without cache entry.
+    """
+
+    def __init__(self, directory=None, max_entries=10000):
+        if not directory:
+            directory = os.path.expanduser("~/.cache/moodleteacher/compiler")
+        self.directory = directory
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return "Compiler cache in {directory}: {entries} entries, {hits} hits, {misses} misses".format(**self.stats())
+
+    def key(self, compiler, cmdline, working_dir):
+        """
+        Compute the cache key for a compiler run.
+
+        Args:
+            compiler (tuple): The compiler definition.
+            cmdline (tuple):  The complete command-line for the compiler.
+            working_dir (str): The directory the compiler runs in.
+        """
+        sha = hashlib.sha256(json.dumps([list(compiler), list(cmdline)]).encode('utf-8'))
+        # Included headers or imported classes are not part of the command-line,
+        # so all files in the working directory are considered
+        for name in sorted(_snapshot(working_dir)):
+            sha.update(name.encode('utf-8') + b'\0')
+            with open(os.path.join(working_dir, name), 'rb') as f:
+                storage.update_hash(sha, f)
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def object_key(self, cmdline, working_dir, source):
+        """
+        Compute the cache key for compiling a single translation unit.
+        Only the source file and the header files in the working directory are considered,
+        so that unchanged object files are found again after other files changed.
+
+        Args:
+            cmdline (tuple):   The complete command-line for the compiler.
+            working_dir (str): The directory the compiler runs in.
+            source (str):      The file path of the translation unit, relative to working_dir.
+        """
+        sha = hashlib.sha256(json.dumps(list(cmdline)).encode('utf-8'))
+        names = [name for name in _snapshot(working_dir) if name.endswith(HEADER_EXTENSIONS)]
+        for name in [source] + sorted(names):
+            sha.update(name.encode('utf-8') + b'\0')
+            with open(os.path.join(working_dir, name), 'rb') as f:
+                storage.update_hash(sha, f)
+            sha.update(b'\0')
+        return sha.hexdigest()
+
+    def restore(self, key, working_dir):
+        """
+        Copy the cached compiler output into the working directory.
+
+        Returns:
+            bool: False if there is no cache entry.
+        """
+        entry_dir = os.path.join(self.directory, key)
+        if not os.path.isdir(entry_dir):
+            with self._lock:
+                self.misses += 1
+            return False
+        for name in _snapshot(entry_dir):
+            target = os.path.join(working_dir, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(os.path.join(entry_dir, name), target)
+        os.utime(entry_dir)
+        with self._lock:
+            self.hits += 1
+        logger.debug("Restored compiler output from cache entry {0}".format(key))
+        return True
+
+    def snapshot(self, working_dir):
+        """
+        Record the state of the working directory before a compiler run, for :meth:`store`.
+        """
+        return _snapshot(working_dir)
+
+    def store(self, key, working_dir, before):
+        """
+        Add all files that were created or changed since the snapshot `before` to the cache.
+        """
+        names = [name for name, info in _snapshot(working_dir).items() if before.get(name) != info]
+        self.store_files(key, working_dir, names)
+
+    def store_files(self, key, working_dir, names):
+        """
+        Add the given files from the working directory to the cache.
+        """
+        entry_dir = os.path.join(self.directory, key)
+        tmp_dir = tempfile.mkdtemp(prefix='tmp_', dir=self.directory)
+        for name in names:
+            target = os.path.join(tmp_dir, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(os.path.join(working_dir, name), target)
+        try:
+            os.rename(tmp_dir, entry_dir)
+            logger.debug("Stored compiler output as cache entry {0}".format(key))
+        except OSError:
+            # Stored in parallel by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._evict()
+
+    def _entries(self):
+        return [entry for entry in os.listdir(self.directory) if not entry.startswith('tmp_')]
+
+    def _evict(self):
+        entries = self._entries()
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda entry: os.path.getmtime(os.path.join(self.directory, entry)))
+        for entry in entries[:len(entries) - self.max_entries]:
+            shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+            logger.debug("Evicted {0} from compiler cache".format(entry))
+
+    def stats(self):
+        """
+        Returns:
+            dict: The cache directory, number of entries, and hit and miss counts.
+        """
+        return {'directory': self.directory,
+                'entries': len(self._entries()),
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def clear(self):
+        """
+        Remove all cached compiler output.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
@@ -7,7 +7,11 @@ import pickle
 
 from getpass import getpass
 
-from moodleteacher.requests import get_tokens
+from moodleteacher.requests import get_tokens, create_session
+from moodleteacher.retry import RetryPolicy, CircuitBreaker
+
+import logging
+logger = logging.getLogger('moodleteacher')
 
 
 class MoodleConnection():
@@ -18,8 +22,11 @@ class MoodleConnection():
     ws_url = None
     ws_params = {}
     moodle_host = None
+    session = None
+    retry_policy = None
+    download_cache = None
 
-    def __init__(self, moodle_host=None, token=None, interactive=False, is_fake=False, timeout=5):
+    def __init__(self, moodle_host=None, token=None, interactive=False, is_fake=False, timeout=5, pool_size=10, retry_policy=None, download_cache=None):
         """
         Configures a connection to a Moodle server.
 
@@ -29,6 +36,10 @@ class MoodleConnection():
             interactive (bool): Prompt interactively for parameters, if needed.
             is_fake (bool):     Create fake connection for testing purposes.
             timeout (int):      Timeout for HTTP requests.
+            pool_size (int):    Number of keep-alive HTTP connections kept open to the Moodle host.
+            retry_policy (RetryPolicy): Retry behavior for failed HTTP requests. The default policy
+                                        uses exponential backoff and a circuit breaker.
+            download_cache (DownloadCache): Optional local cache for file downloads.
         """
         self.is_fake = is_fake
         if is_fake:
@@ -57,6 +68,29 @@ class MoodleConnection():
         self.ws_params['wstoken'] = token
         self.ws_params['moodlewsrestformat'] = 'json'
         self.ws_url = moodle_host + "/webservice/rest/server.php"
+        self.session = create_session(pool_size)
+        if retry_policy:
+            self.retry_policy = retry_policy
+        else:
+            self.retry_policy = RetryPolicy(circuit_breaker=CircuitBreaker())
+        self.download_cache = download_cache
+
+    def close(self):
+        """
+        Close all pooled HTTP connections to the Moodle server.
+        """
+        if self.session:
+            self.session.close()
+        if self.retry_policy:
+            logger.info("HTTP request statistics: {0}".format(self.retry_policy))
+        if self.download_cache:
+            logger.info(str(self.download_cache))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __str__(self):
         if self.is_fake:
@@ -7,7 +7,7 @@ from collections import defaultdict
 from .requests import MoodleRequest
 from .users import MoodleUser, MoodleGroup
 from .files import MoodleFolder
-from .grades import MoodleGradeItem
+from .grades import MoodleGradeItem, MoodleGradeIndex
 
 import logging
 logger = logging.getLogger('moodleteacher')
@@ -52,6 +52,7 @@ class MoodleCourse():
         self.id_ = course_id
         self.fullname = fullname
         self.shortname = shortname
+        self._grade_index = None
         self.get_admin_options(conn)
         # fetch list of users and groups in this course
         params = {'courseid': self.id_}
@@ -111,6 +112,32 @@ class MoodleCourse():
                 result.append(MoodleGradeItem.from_raw_json(gradeitem))
         return result
 
+    @property
+    def grade_index(self):
+        """
+        The :class:`MoodleGradeIndex` for this course, loaded on first access.
+        """
+        if self._grade_index is None:
+            self._grade_index = MoodleGradeIndex(self).refresh()
+        return self._grade_index
+
+    def refresh_grades(self):
+        """
+        Fetch the current grades of all users in this course.
+        """
+        self._grade_index = MoodleGradeIndex(self).refresh()
+        return self._grade_index
+
+    def update_grades(self, user_ids, assignment, gradeformatted):
+        """
+        Update the grades of the given users after they were saved to Moodle,
+        without fetching the grade index again. Nothing happens if the grade
+        index is not loaded yet, since its first access fetches the current grades.
+        """
+        if self._grade_index is not None:
+            for user_id in user_ids:
+                self._grade_index.set(user_id, assignment, gradeformatted)
+
     def get_folders(self):
         """
         Determine folders that are part of the course.
@@ -66,3 +66,11 @@ class NoFilesException(JobException):
     Indication that the student submission contains no files.
     """
     pass
+
+
+class CircuitOpenException(Exception):
+    """
+    Indication that requests to the Moodle server are currently not sent,
+    since too many of the recent requests failed.
+    """
+    pass
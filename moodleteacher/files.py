@@ -1,15 +1,19 @@
+import hashlib
 import mimetypes
 import zipfile
 import tarfile
 from io import BytesIO
 import os
 import os.path
-import re
 import shutil
-from tempfile import NamedTemporaryFile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from tempfile import SpooledTemporaryFile
 
 from .exceptions import *
 from .requests import BaseRequest
+from . import storage
 
 import logging
 logger = logging.getLogger('moodleteacher')
@@ -33,20 +37,15 @@ class MoodleFolder():
         self.visible = bool(raw_json['visible'])
         self.files = []
         for file_detail in raw_json['contents']:
-            f = MoodleFile.from_url(self.conn, file_detail['fileurl'])
-            if not f.mime_type:
-                f.mime_type = file_detail['mimetype']
-            if not f.size:
-                f.size = file_detail['filesize']
-            if not f.relative_path:
-                f.relative_path = file_detail['filepath']
-            if not f.time_modified:
-                f.time_modified = file_detail['timemodified']
             # Testing showed that raw_json['name'] might contain broken
             # unicode characters, while file_detail['filename'] is rendered
             # correctly.
-            if f.name != file_detail['filename']:
-                f.name = file_detail['filename']
+            f = MoodleFile.from_url(self.conn, file_detail['fileurl'],
+                                    name=file_detail['filename'],
+                                    time_modified=file_detail['timemodified'],
+                                    mime_type=file_detail['mimetype'])
+            f.size = file_detail['filesize']
+            f.relative_path = file_detail['filepath']
             f.folder = self
             f.owner = self.course.get_user(file_detail['userid'])
             self.files.append(f)
@@ -55,9 +54,81 @@ class MoodleFolder():
         return "{0.name} ({1} files)".format(self, len(self.files))
 
 
+# Number of bytes needed for content sniffing
+SNIFF_SIZE = 512
+
+# Magic byte prefixes and their content types
+MAGIC_BYTES = [(b'PK\x03\x04', 'application/zip'),
+               (b'PK\x05\x06', 'application/zip'),       # empty archive
+               (b'\x1f\x8b', 'application/gzip'),
+               (b'%PDF-', 'application/pdf'),
+               (b'\x89PNG\r\n\x1a\n', 'image/png'),
+               (b'\xff\xd8\xff', 'image/jpeg'),
+               (b'GIF87a', 'image/gif'),
+               (b'GIF89a', 'image/gif'),
+               (b'\x7fELF', 'application/x-executable')]
+
+# Byte order marks of text files
+TEXT_BOMS = [b'\xef\xbb\xbf', b'\xff\xfe', b'\xfe\xff']
+
+
+def _is_utf8_text(head):
+    if b'\x00' in head:
+        return False
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # The head may end in the middle of a multi-byte character
+        return e.start >= len(head) - 3 and e.reason == 'unexpected end of data'
+    return True
+
+
+def sniff_content_type(head, name=''):
+    """
+    Determine the content type of a file from its first bytes.
+
+    Known binary formats are identified by their magic bytes. Otherwise,
+    the content type is guessed from the file name, and finally from
+    the question if the content looks like text.
+
+    Args:
+        head (bytes): The first SNIFF_SIZE bytes of the file content.
+        name (str):   The file name.
+    """
+    for magic, content_type in MAGIC_BYTES:
+        if head.startswith(magic):
+            return content_type
+    if head[257:262] == b'ustar':
+        return 'application/x-tar'
+    content_type = mimetypes.guess_type(name)[0]
+    if content_type:
+        return content_type
+    for bom in TEXT_BOMS:
+        if head.startswith(bom):
+            return 'text/plain'
+    if _is_utf8_text(head):
+        return 'text/plain'
+    logger.warning("Unidentifiable content type for {0}, declaring it as binary.".format(name))
+    return 'application/octet-stream'
+
+
+def prefetch_files(files, max_workers=8):
+    """
+    Download the content of all given :class:`MoodleFile` objects in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda f: f.prefetch(), files))
+    return files
+
+
 class MoodleFile():
     '''
         An in-memory file representation that was downloaded from Moodle.
+
+        Files created with :meth:`from_url` only carry the metadata. The
+        content is downloaded on first access, or explicitly with :meth:`prefetch`.
+        Downloads larger than SPOOL_THRESHOLD bytes are kept in a temporary file
+        instead of memory.
     '''
     # Content types we don't know how to deal with in the preview
     UNKNOWN_CONTENT = ['application/vnd.openxmlformats-officedocument.wordprocessingml.document',
@@ -70,6 +141,10 @@ class MoodleFile():
     TAR_CONTENT = ['application/x-gzip', 'application/gzip', 'application/tar',
                    'application/tar+gzip', 'application/x-gtar', 'application/x-tgz',
                    'application/x-tar']
+    # Download size in bytes above which the content is spooled to disk
+    SPOOL_THRESHOLD = 10 * 1024 * 1024
+    # Chunk size for streamed downloads and file copies
+    CHUNK_SIZE = 64 * 1024
 
     def __str__(self):
         result = "{0.relative_path}{0.name}".format(self)
@@ -77,9 +152,9 @@ class MoodleFile():
             result += " ({0.size} Bytes)".format(self)
         return result
 
-    def __init__(self, name, content, conn=None, url=None, encoding=None, content_type=None, mime_type=None, size=None, folder=None, relative_path='', owner=None, time_modified=None):
+    def __init__(self, name, content=None, conn=None, url=None, encoding=None, content_type=None, mime_type=None, size=None, folder=None, relative_path='', owner=None, time_modified=None):
         self.name = name
-        self.content = content
+        self._content = content
         self.conn = conn
         self.url = url
         self.encoding = encoding
@@ -89,52 +164,159 @@ class MoodleFile():
         self.relative_path = relative_path
         self.owner = owner
         self.time_modified = time_modified
+        self._spool = None
+        self._lock = threading.Lock()
 
-        # Determine missing content type
-        if not content_type:
-            if self.name.startswith('__MACOSX'):
-                self.content_type = 'text/plain'
-            elif self._is_zip_content:
-                self.content_type = 'application/zip'
-                logger.debug("Detected ZIP file content by probing")
-            elif self._is_tar_content:
-                self.content_type = 'application/tar'
-                logger.debug("Detected TAR file content by probing")
-            else:
-                with NamedTemporaryFile(suffix=self.name) as tmp:
-                    tmp.write(self.content)
-                    tmp.flush()
-                    self.content_type = mimetypes.guess_type(tmp.name)[0]
-                    if self.content_type is None:
-                        logger.warn("Unidentifiable content type, declaring it as text.")
-                        self.content_type = "application/text"
-                    else:
-                        logger.debug(
-                            "Detected {0} file content by mime guessing".format(self.content_type))
+        if content_type:
+            self._content_type = content_type
+        elif content is not None:
+            self._content_type = self._detect_content_type()
         else:
-            self.content_type = content_type
+            # Not downloaded so far, rely on the Moodle metadata if possible
+            self._content_type = mime_type
+
+    @property
+    def content(self):
+        """
+        The file content, downloaded from Moodle on first access.
+
+        For content that was spooled to disk, this reads the complete file into memory.
+        Use :meth:`open_content` for large files instead.
+        """
+        self.prefetch()
+        if self._spool:
+            logger.debug("Reading spooled content of {0} into memory.".format(self.name))
+            self._spool.seek(0)
+            return self._spool.read()
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._spool = None
+
+    @contextmanager
+    def open_content(self):
+        """
+        Provides a binary file object for reading the file content,
+        without loading spooled content into memory.
+        """
+        self.prefetch()
+        if self._spool:
+            self._spool.seek(0)
+            yield self._spool
+        elif isinstance(self._content, str):
+            yield BytesIO(self._content.encode(self.encoding if self.encoding else 'utf-8'))
+        else:
+            yield BytesIO(self._content)
+
+    @property
+    def content_type(self):
+        if self._content_type is None and self.url:
+            self._download()
+        return self._content_type
+
+    @content_type.setter
+    def content_type(self, value):
+        self._content_type = value
+
+    @property
+    def is_downloaded(self):
+        return self._content is not None or self._spool is not None
+
+    def _detect_content_type(self):
+        """
+        Determine missing content type from the first bytes of the content.
+        """
+        if self.name.startswith('__MACOSX'):
+            return 'text/plain'
+        if isinstance(self._content, str):
+            head = self._content[:SNIFF_SIZE].encode('utf-8', errors='ignore')
+        else:
+            with self.open_content() as content:
+                head = content.read(SNIFF_SIZE)
+        content_type = sniff_content_type(head, self.name)
+        logger.debug("Detected {0} file content by sniffing".format(content_type))
+        return content_type
+
+    def _load_cached(self, path, content_type, encoding):
+        self.size = os.path.getsize(path)
+        if self.size > self.SPOOL_THRESHOLD:
+            self._spool = open(path, 'rb')
+        else:
+            with open(path, 'rb') as cached:
+                self._content = cached.read()
+        if not self.encoding:
+            self.encoding = encoding
+        if not self._content_type:
+            self._content_type = content_type
+
+    def _download(self):
+        with self._lock:
+            if self.is_downloaded:
+                return
+            cache = getattr(self.conn, 'download_cache', None)
+            if cache and self.time_modified:
+                cached = cache.lookup(self.url, self.time_modified)
+                if cached:
+                    self._load_cached(*cached)
+                    return
+            logger.debug("Downloading {0} ...".format(self.url))
+            response = BaseRequest(self.conn, self.url).get_absolute(params={'token': self.conn.token}, stream=True)
+            spool = SpooledTemporaryFile(max_size=self.SPOOL_THRESHOLD, prefix='moodleteacher_')
+            size = 0
+            for chunk in response.iter_content(self.CHUNK_SIZE):
+                spool.write(chunk)
+                size += len(chunk)
+            response.close()
+            if size > self.SPOOL_THRESHOLD:
+                logger.debug("Spooled {0} bytes of {1} to disk.".format(size, self.name))
+                self._spool = spool
+            else:
+                spool.seek(0)
+                self._content = spool.read()
+                spool.close()
+            if not self.size:
+                self.size = size
+            if not self.encoding:
+                self.encoding = response.encoding
+            if not self._content_type:
+                self._content_type = response.headers.get('content-type')
+            if not self._content_type:
+                self._content_type = self._detect_content_type()
+            if cache and self.time_modified:
+                with self.open_content() as content:
+                    cache.store(self.url, self.time_modified, content, self._content_type, self.encoding)
+
+    def prefetch(self):
+        """
+        Download the file content now, if not done so far.
+        """
+        if not self.is_downloaded and self.url:
+            self._download()
+        return self
+
+    def content_hash(self):
+        """
+        Returns:
+            str: The SHA-256 hash of the file content, as hex string.
+        """
+        with self.open_content() as content:
+            return storage.update_hash(hashlib.sha256(), content, self.CHUNK_SIZE).hexdigest()
 
     @classmethod
     def from_url(cls, conn, url, name=None, time_modified=None, mime_type=None):
-        # fetch file from url
-        response = BaseRequest(conn, url).get_absolute(params={'token': conn.token})
-
+        """
+        Create a file object for a Moodle download URL. The content
+        is not fetched before it is accessed.
+        """
         if not name:
-            try:
-                disp = response.headers['content-disposition']
-                name = re.findall('filename="(.+)"', disp)[0]
-            except KeyError:
-                name = url.split('/')[-1]
-
+            name = url.split('/')[-1]
         return cls(name=name,
-                   content=response.content,
                    conn=conn,
                    url=url,
-                   encoding=response.encoding,
                    time_modified=time_modified,
-                   mime_type=mime_type,
-                   content_type=response.headers.get('content-type')
-                   )
+                   mime_type=mime_type)
 
     @classmethod
     def from_local_data(cls, name, content, content_type):
@@ -146,25 +328,10 @@ class MoodleFile():
         with open(fpath, 'rb') as fcontent:
             return cls(name=name, content=fcontent.read())
 
-    @property
-    def _is_zip_content(self):
-        try:
-            zipfile.ZipFile(BytesIO(self.content))
-            return True
-        except Exception:
-            return False
-
-    @property
-    def _is_tar_content(self):
-        try:
-            tarfile.open(BytesIO(self.content))
-            return True
-        except Exception:
-            return False
-
     @property
     def is_binary(self):
-        return False if isinstance(self.content, str) else True
+        self.prefetch()
+        return False if isinstance(self._content, str) else True
 
     @property
     def is_archive(self):
@@ -233,9 +400,13 @@ class MoodleFile():
                 logger.warn("Recoding of text file {0} was requested, but the file download has no encoding information. Trying it anway ...".format(name))
                 text = self.content.decode("ISO-8859-1", errors="ignore")
             f.write(text.encode("utf-8"))
-        else:
+        elif self.is_binary:
             # plain copy
-            f = open(target_dir + name, 'w+b' if self.is_binary else 'w+')
+            f = open(target_dir + name, 'w+b')
+            with self.open_content() as content:
+                shutil.copyfileobj(content, f, self.CHUNK_SIZE)
+        else:
+            f = open(target_dir + name, 'w+')
             f.write(self.content)
         f.close()
 
@@ -259,7 +430,8 @@ class MoodleFile():
             recode (boolean):             Recode the submission files to UTF-8 text, to avoid compiler problems.
                                           When the student submission is an archive, this flag has no effect.
         """
-        assert(self.content)
+        self.prefetch()
+        assert(self._content or self._spool)
         self._check_disk_space(target_dir)
 
         dircontent = os.listdir(target_dir)
@@ -267,44 +439,45 @@ class MoodleFile():
                      (target_dir, str(dircontent)))
 
         if self.is_zip:
-            input_zip = zipfile.ZipFile(BytesIO(self.content))
-            if remove_directories:
-                logger.debug("Ignoring directories in ZIP archive.")
-                infolist = input_zip.infolist()
-                for file_in_zip in infolist:
-                    if not file_in_zip.filename.endswith('/'):
-                        target_name = target_dir + os.sep + \
-                            os.path.basename(file_in_zip.filename)
-                        logger.debug("Writing {0} to {1}".format(
-                            file_in_zip.filename, target_name))
-                        with open(target_name, "wb") as target:
-                            target.write(input_zip.read(file_in_zip))
-                    else:
-                        logger.debug("Ignoring ZIP entry '{0}'".format(
-                            file_in_zip.filename))
-            else:
-                logger.debug("Keeping directories from ZIP archive.")
-                input_zip.extractall(target_dir)
+            with self.open_content() as content:
+                input_zip = zipfile.ZipFile(content)
+                if remove_directories:
+                    logger.debug("Ignoring directories in ZIP archive.")
+                    infolist = input_zip.infolist()
+                    for file_in_zip in infolist:
+                        if not file_in_zip.filename.endswith('/'):
+                            target_name = target_dir + os.sep + \
+                                os.path.basename(file_in_zip.filename)
+                            logger.debug("Writing {0} to {1}".format(
+                                file_in_zip.filename, target_name))
+                            with open(target_name, "wb") as target, input_zip.open(file_in_zip) as source:
+                                shutil.copyfileobj(source, target, self.CHUNK_SIZE)
+                        else:
+                            logger.debug("Ignoring ZIP entry '{0}'".format(
+                                file_in_zip.filename))
+                else:
+                    logger.debug("Keeping directories from ZIP archive.")
+                    input_zip.extractall(target_dir)
         elif self.is_tar:
-            input_tar = tarfile.open(fileobj=BytesIO(self.content))
-            if remove_directories:
-                logger.debug("Ignoring directories in TAR archive.")
-                infolist = input_tar.getmembers()
-                for file_in_tar in infolist:
-                    if file_in_tar.isfile():
-                        target_name = target_dir + os.sep + \
-                            os.path.basename(file_in_tar.name)
-                        logger.debug("Writing {0} to {1}".format(
-                            file_in_tar.name, target_name))
-                        with open(target_name, "wb") as target:
-                            target.write(input_tar.extractfile(
-                                file_in_tar).read())
-                    else:
-                        logger.debug(
-                            "Ignoring TAR entry '{0}'".format(file_in_tar.name))
-            else:
-                logger.debug("Keeping directories from TAR archive.")
-                input_tar.extractall(target_dir)
+            with self.open_content() as content:
+                input_tar = tarfile.open(fileobj=content)
+                if remove_directories:
+                    logger.debug("Ignoring directories in TAR archive.")
+                    infolist = input_tar.getmembers()
+                    for file_in_tar in infolist:
+                        if file_in_tar.isfile():
+                            target_name = target_dir + os.sep + \
+                                os.path.basename(file_in_tar.name)
+                            logger.debug("Writing {0} to {1}".format(
+                                file_in_tar.name, target_name))
+                            with open(target_name, "wb") as target:
+                                shutil.copyfileobj(input_tar.extractfile(file_in_tar), target, self.CHUNK_SIZE)
+                        else:
+                            logger.debug(
+                                "Ignoring TAR entry '{0}'".format(file_in_tar.name))
+                else:
+                    logger.debug("Keeping directories from TAR archive.")
+                    input_tar.extractall(target_dir)
         else:
             logger.debug("Assuming non-archive, copying directly.")
             self.save_as(target_dir, self.name, recode)
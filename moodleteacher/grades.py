@@ -1,3 +1,9 @@
+import threading
+import time
+
+from .requests import MoodleRequest
+from .submissions import FEEDBACK_ONLY_GRADE
+
 import logging
 logger = logging.getLogger('moodleteacher')
 
@@ -7,18 +13,236 @@ class MoodleGradeItem():
         A single Moodle grade.
     '''
 
-    def __init__(self, grade_id, item_name, item_cmid, gradeformatted):
+    def __init__(self, grade_id, item_name, item_cmid, gradeformatted, userid=None):
         self.id_ = grade_id
         self.item_name = item_name
         self.item_cmid = item_cmid
         self.gradeformatted = gradeformatted
+        self.userid = userid
 
     @classmethod
-    def from_raw_json(cls, raw_json):
+    def from_raw_json(cls, raw_json, userid=None):
         return cls(grade_id=raw_json['id'],
                    item_name=raw_json['itemname'],
                    item_cmid=raw_json['cmid'],
-                   gradeformatted=raw_json['gradeformatted'])
+                   gradeformatted=raw_json['gradeformatted'],
+                   userid=userid)
 
     def __str__(self):
         return "{0.item_name}: {0.gradeformatted}".format(self)
+
+
+class MoodleGradeIndex():
+    '''
+        The grades of all users in a course, keyed by user ID and course module ID.
+
+        The index is filled with a single bulk request, instead of one request
+        per user. Call :meth:`refresh` to fetch the current state again.
+    '''
+
+    def __init__(self, course):
+        self.course = course
+        self._grades = {}       # key is (user ID, course module ID), value is MoodleGradeItem
+        self._names = {}        # key is (user ID, item name), value is MoodleGradeItem
+
+    def __len__(self):
+        return len(self._grades)
+
+    def _add(self, grade):
+        self._grades[(grade.userid, grade.item_cmid)] = grade
+        self._names[(grade.userid, grade.item_name)] = grade
+
+    def refresh(self):
+        """
+        Fetch the grade report for all users in the course.
+        """
+        params = {'courseid': self.course.id_}
+        response = MoodleRequest(
+            self.course.conn, 'gradereport_user_get_grade_items').post(params).json()
+        self._grades = {}
+        self._names = {}
+        for grade_data in response.get('usergrades', []):
+            assert(grade_data['courseid'] == self.course.id_)
+            for gradeitem in grade_data['gradeitems']:
+                if 'cmid' in gradeitem:
+                    # Only consider real assignments
+                    self._add(MoodleGradeItem.from_raw_json(gradeitem, grade_data['userid']))
+        logger.debug("Loaded {0} grades for course {1}".format(len(self), self.course.id_))
+        return self
+
+    def refresh_assignments(self, assignments):
+        """
+        Fetch the grades for the given assignments only, with mod_assign_get_grades.
+
+        Args:
+            assignments (list): The :class:`MoodleAssignment` objects.
+        """
+        by_id = {assignment.id_: assignment for assignment in assignments}
+        params = {'assignmentids': list(by_id.keys())}
+        response = MoodleRequest(
+            self.course.conn, 'mod_assign_get_grades').post(params).json()
+        for assignment_data in response.get('assignments', []):
+            assignment = by_id[assignment_data['assignmentid']]
+            for grade_data in assignment_data['grades']:
+                grade = float(grade_data['grade'])
+                self._add(MoodleGradeItem(grade_id=grade_data['id'],
+                                          item_name=assignment.name,
+                                          item_cmid=assignment.cmid,
+                                          # Moodle reports missing grades as negative value
+                                          gradeformatted="{0:.2f}".format(grade) if grade >= 0 else "-",
+                                          userid=grade_data['userid']))
+        return self
+
+    def set(self, userid, assignment, gradeformatted):
+        """
+        Update the grade of a user in the given assignment, after it was saved to Moodle.
+        """
+        grade = self.get(userid, assignment)
+        if grade:
+            grade.gradeformatted = gradeformatted
+        else:
+            self._add(MoodleGradeItem(grade_id=None,
+                                      item_name=assignment.name,
+                                      item_cmid=assignment.cmid,
+                                      gradeformatted=gradeformatted,
+                                      userid=userid))
+
+    def get(self, userid, assignment):
+        """
+        Determine the grade of a user in the given assignment.
+
+        Returns:
+            :class:`MoodleGradeItem` object, or None if not known.
+        """
+        if assignment.cmid:
+            return self._grades.get((userid, assignment.cmid))
+        else:
+            return self._names.get((userid, assignment.name))
+
+
+class GradeWriteResult():
+    '''
+        The outcome of a single grade update sent by :class:`MoodleGradeWriter`.
+    '''
+
+    def __init__(self, submission, grade, feedback, data=None):
+        self.submission = submission
+        self.grade = grade
+        self.feedback = feedback
+        self.data = data
+        self.success = None       # None as long as the update is not sent
+        self.error = None
+
+    def __str__(self):
+        state = 'pending' if self.success is None else 'ok' if self.success else 'failed: {0}'.format(self.error)
+        return "Grade {0.grade} for user {1}: {2}".format(self, self.data['userid'] if self.data else None, state)
+
+
+class MoodleGradeWriter():
+    '''
+        Collects grade and feedback updates, and sends them in chunks
+        with the mod_assign_save_grades web service function.
+
+        Updates are sent when `chunk_size` updates are queued, when the oldest
+        queued update is older than `max_delay` seconds, or on an explicit
+        :meth:`flush`. When a chunk is rejected by Moodle, its updates are sent
+        one by one, so that :attr:`results` tells the outcome for each update.
+
+        The writer can be used as context manager, which flushes on exit.
+    '''
+
+    def __init__(self, conn, chunk_size=50, max_delay=None):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.max_delay = max_delay
+        self.results = []
+        self._pending = []
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, submission, grade, feedback=None):
+        """
+        Queue a grade update, see :meth:`MoodleSubmission.save_grade`.
+
+        Returns:
+            :class:`GradeWriteResult`: The result object, updated when the grade is sent.
+        """
+        result = GradeWriteResult(submission, grade, feedback, submission._grade_data(grade, feedback))
+        with self._lock:
+            self.results.append(result)
+            if result.data is None:
+                result.success = False
+                result.error = "Feedback comments are not allowed for this assignment."
+                return result
+            self._pending.append(result)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = len(self._pending) >= self.chunk_size or \
+                (self.max_delay is not None and time.monotonic() - self._oldest >= self.max_delay)
+        if due:
+            self.flush()
+        return result
+
+    def add_feedback(self, submission, feedback):
+        """
+        Queue a feedback update, see :meth:`MoodleSubmission.save_feedback`.
+        """
+        return self.add(submission, FEEDBACK_ONLY_GRADE, feedback)
+
+    def flush(self):
+        """
+        Send all queued updates to Moodle.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._oldest = None
+        # The assignment ID is a parameter of the whole call
+        by_assignment = {}
+        for result in pending:
+            by_assignment.setdefault(result.data['assignmentid'], []).append(result)
+        for assignment_id, results in by_assignment.items():
+            for start in range(0, len(results), self.chunk_size):
+                self._send_chunk(assignment_id, results[start:start + self.chunk_size])
+
+    def failed(self):
+        """
+        Returns:
+            list: The :class:`GradeWriteResult` objects of all failed updates.
+        """
+        return [result for result in self.results if result.success is False]
+
+    def _send_chunk(self, assignment_id, results):
+        data = {'assignmentid': assignment_id,
+                'applytoall': int(True)}
+        for i, result in enumerate(results):
+            for key in ['userid', 'grade', 'attemptnumber', 'addattempt', 'workflowstate']:
+                data['grades[{0}][{1}]'.format(i, key)] = result.data[key]
+            for key in ['text', 'format']:
+                data['grades[{0}][plugindata][assignfeedbackcomments_editor][{1}]'.format(i, key)] = \
+                    result.data['plugindata[assignfeedbackcomments_editor][{0}]'.format(key)]
+        logger.debug("Sending {0} grades for assignment {1}".format(len(results), assignment_id))
+        try:
+            MoodleRequest(self.conn, 'mod_assign_save_grades').post(data=data)
+        except Exception as e:
+            logger.error("Saving {0} grades at once failed ({1}), sending them one by one.".format(len(results), e))
+            for result in results:
+                try:
+                    MoodleRequest(self.conn, 'mod_assign_save_grade').post(data=result.data)
+                    result.success = True
+                except Exception as e:
+                    logger.error("Saving grade for user {0} failed: {1}".format(result.data['userid'], e))
+                    result.success = False
+                    result.error = str(e)
+        else:
+            for result in results:
+                result.success = True
+        for result in results:
+            if result.success:
+                result.submission._update_grade_index(result.grade)
@@ -0,0 +1,218 @@
+"""
+A durable local journal for grade and feedback updates.
+"""
+
+import json
+import os
+import os.path
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import requests
+
+from .exceptions import CircuitOpenException
+from .requests import MoodleRequest
+from .submissions import FEEDBACK_ONLY_GRADE
+
+import logging
+logger = logging.getLogger('moodleteacher')
+
+
+class GradeJournal():
+    """
+    An append-only journal file for grade and feedback updates, which is
+    drained by a background thread.
+
+    Each update is written to the journal before :meth:`add` returns, so that
+    no grading result is lost when the network drops or the process crashes.
+    The background thread sends the updates to Moodle in their original order,
+    and waits with exponential backoff while Moodle is not reachable. A journal
+    opened on an existing file resumes with all updates that were not sent so far.
+
+    The journal offers the same :meth:`add` / :meth:`add_feedback` interface as
+    :class:`MoodleGradeWriter`, and can therefore be given to a validation
+    :class:`Job` as `grade_writer`.
+
+    Attributes:
+        path (str):               The journal file.
+        retry_delay (float):      Initial waiting time after a failed update.
+        max_retry_delay (float):  Upper limit for the waiting time after failed updates.
+    """
+
+    def __init__(self, conn, path=None, retry_delay=5, max_retry_delay=300, autostart=True):
+        if not path:
+            path = os.path.expanduser("~/.cache/moodleteacher/grades.journal")
+        self.conn = conn
+        self.path = path
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.sent = 0
+        self.failed = []          # List of (update data, error message)
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._replay()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if self._pending:
+            logger.info("Resuming {0} unsent grade updates from {1}".format(len(self._pending), self.path))
+        if autostart:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _replay(self):
+        """
+        Read the pending updates from an existing journal, and compact it.
+        """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Incomplete last line after a crash
+                    logger.warning("Ignoring broken entry in grade journal {0}".format(self.path))
+                    continue
+                if entry['op'] == 'grade':
+                    self._pending[entry['id']] = entry['data']
+                else:
+                    self._pending.pop(entry['id'], None)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as journal:
+            for entry_id, data in self._pending.items():
+                journal.write(json.dumps({'op': 'grade', 'id': entry_id, 'data': data}) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, entry):
+        # Called with the condition lock held
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def add(self, submission, grade, feedback=None):
+        """
+        Store a grade update in the journal, see :meth:`MoodleSubmission.save_grade`.
+        """
+        data = submission._grade_data(grade, feedback)
+        if data is None:
+            return
+        entry_id = uuid.uuid4().hex
+        with self._condition:
+            self._append({'op': 'grade', 'id': entry_id, 'data': data, 'time': time.time()})
+            self._pending[entry_id] = data
+            self._condition.notify_all()
+
+    def add_feedback(self, submission, feedback):
+        """
+        Store a feedback update in the journal, see :meth:`MoodleSubmission.save_feedback`.
+        """
+        self.add(submission, FEEDBACK_ONLY_GRADE, feedback)
+
+    def start(self):
+        """
+        Start the background thread that sends the journal entries to Moodle.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='moodleteacher-journal', daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _is_transient(error):
+        """
+        Check if a failed update should be sent again later.
+        """
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, CircuitOpenException)):
+            return True
+        if isinstance(error, requests.exceptions.HTTPError):
+            return error.response is None or error.response.status_code >= 500
+        return False
+
+    def _run(self):
+        delay = self.retry_delay
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                entry_id, data = next(iter(self._pending.items()))
+            try:
+                MoodleRequest(self.conn, 'mod_assign_save_grade').post(data=data)
+            except Exception as e:
+                if not self._is_transient(e):
+                    # Moodle rejected the update, sending it again would not help
+                    logger.error("Moodle rejected grade update for user {0}: {1}".format(data['userid'], e))
+                    with self._condition:
+                        if self._file.closed:
+                            return
+                        self._append({'op': 'failed', 'id': entry_id, 'error': str(e)})
+                        del self._pending[entry_id]
+                        self.failed.append((data, str(e)))
+                        self._condition.notify_all()
+                    continue
+                logger.warning("Sending grade update failed ({0}), trying again in {1} seconds.".format(e, delay))
+                with self._condition:
+                    self._condition.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+            with self._condition:
+                if self._file.closed:
+                    # close() gave up waiting for this request, the entry stays in the journal
+                    return
+                self._append({'op': 'done', 'id': entry_id})
+                del self._pending[entry_id]
+                self.sent += 1
+                self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all journal entries are sent.
+
+        Returns:
+            bool: False if the timeout expired before.
+        """
+        self.start()
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, timeout=10):
+        """
+        Wait for pending updates, at most `timeout` seconds, and stop the background thread.
+        Unsent updates remain in the journal for the next run. Use :meth:`flush` before,
+        in order to wait until Moodle accepted all updates.
+
+        A request that is still running after the timeout is not waited for. The
+        background thread is a daemon thread, and the update stays in the journal.
+        """
+        if self._stopped:
+            return
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        if self._thread:
+            self.flush(timeout)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread:
+            self._thread.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+            if self._thread.is_alive():
+                logger.warning("Grade update is still being sent, keeping it in {0}".format(self.path))
+        with self._condition:
+            self._file.close()
@@ -1,5 +1,6 @@
 import collections
 import requests
+from requests.adapters import HTTPAdapter
 from unittest.mock import Mock
 import logging
 logger = logging.getLogger('moodleteacher')
@@ -16,6 +17,24 @@ def get_tokens(base_url, username, password, timeout):
     return result.json()
 
 
+def create_session(pool_size=10):
+    """
+    Create a HTTP session with a pool of keep-alive connections.
+
+    All requests to the Moodle host share this session, so that
+    TCP and TLS connections are re-used instead of being opened
+    for each web service call or file download.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open per host.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 class BaseRequest():
     """
     A HTTP(S) request that considers :class:`MoodleConnection` settings.
@@ -24,7 +43,7 @@ class BaseRequest():
         self.conn = conn
         self.url = url
 
-    def get_absolute(self, params=None):
+    def get_absolute(self, params=None, stream=False):
         if self.conn.is_fake:
             logger.info("Fake connection, not performing web service GET call.")
             the_response = Mock(spec=requests.models.Response)
@@ -32,13 +51,9 @@ class BaseRequest():
             the_response.status_code = 200
             return the_response
         logger.debug("Performing web service GET call ...")
-        while (True):
-            try:
-                result = requests.get(self.url, params=params, timeout=self.conn.timeout)
-            except requests.exceptions.Timeout:
-                logger.error("Timeout for GET request to {0} after {1} seconds, trying again.".format(self.url, self.conn.timeout))
-                continue
-            break
+        result = self.conn.retry_policy.call(
+            lambda: self.conn.session.get(self.url, params=params, timeout=self.conn.timeout, stream=stream),
+            "GET request to {0}".format(self.url))
         logger.debug("Result status code: {0}".format(result.status_code))
         result.raise_for_status()
         return result
@@ -51,13 +66,9 @@ class BaseRequest():
             the_response.status_code = 200
             return the_response
         logger.debug("Performing web service POST call ...")
-        while (True):
-            try:
-                result = requests.post(self.url, params=params, data=data, timeout=self.conn.timeout)
-            except requests.exceptions.Timeout:
-                logger.error("Timeout for POST request to {0} after {1} seconds, trying again.".format(self.url, self.conn.timeout))
-                continue
-            break
+        result = self.conn.retry_policy.call(
+            lambda: self.conn.session.post(self.url, params=params, data=data, timeout=self.conn.timeout),
+            "POST request to {0}".format(self.url))
         logger.debug("Result status code: {0}".format(result.status_code))
         result.raise_for_status()
         return result
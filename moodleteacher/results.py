@@ -0,0 +1,160 @@
+"""
+A local store for validation results.
+"""
+
+import json
+import os
+import os.path
+import threading
+import time
+from contextlib import closing
+
+from . import storage
+
+import logging
+logger = logging.getLogger('moodleteacher')
+
+
+class ResultStore():
+    """
+    A SQLite database with the results of all validation jobs.
+
+    Results are stored under a key that combines the content hash of the
+    submission files and of the validator. When the same key is validated again,
+    :meth:`Job.start` takes the stored result instead of running the validator.
+    All runs are kept as history, including the outcome and the duration.
+
+    The store is enabled by passing it to :class:`Job`.
+
+    Attributes:
+        path (str):                 The database file.
+        repost_identical (bool):    Send feedback to Moodle even if the same feedback
+                                    was already sent for the submission before.
+        hits (int):                 Number of jobs that used a stored result.
+        misses (int):               Number of jobs without stored result.
+    """
+    PASS = 'pass'
+    FAIL = 'fail'
+
+    def __init__(self, path=None, repost_identical=True):
+        if not path:
+            path = os.path.expanduser("~/.cache/moodleteacher/results.sqlite")
+        self.path = path
+        self.repost_identical = repost_identical
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as db, db:
+            db.execute('''CREATE TABLE IF NOT EXISTS results (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              key TEXT NOT NULL,
+                              validator TEXT NOT NULL,
+                              assignment INTEGER,
+                              userid INTEGER,
+                              groupid INTEGER,
+                              outcome TEXT NOT NULL,
+                              feedback TEXT,
+                              duration REAL,
+                              cached INTEGER NOT NULL,
+                              created REAL NOT NULL,
+                              usage TEXT)''')
+            if 'usage' not in [column[1] for column in db.execute('PRAGMA table_info(results)')]:
+                # Database from an older version
+                db.execute('ALTER TABLE results ADD COLUMN usage TEXT')
+            db.execute('CREATE INDEX IF NOT EXISTS results_key ON results (key)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_submission ON results (assignment, userid, groupid)')
+
+    def __str__(self):
+        return "Result store in {path}: {runs} runs, {hits} hits, {misses} misses".format(**self.stats())
+
+    def _connect(self):
+        return storage.connect(self.path)
+
+    @staticmethod
+    def _submission_ids(submission):
+        return (submission.assignment.id_ if submission.assignment else None,
+                submission.userid,
+                submission.groupid)
+
+    def lookup(self, key):
+        """
+        Find the latest stored result for a validation key.
+
+        Returns:
+            dict: The stored result, or None.
+        """
+        with closing(self._connect()) as db:
+            row = db.execute('SELECT * FROM results WHERE key=? ORDER BY id DESC LIMIT 1', (key,)).fetchone()
+        self.count_lookup(row is not None)
+        return dict(row) if row else None
+
+    def count_lookup(self, hit):
+        """
+        Count a lookup in the statistics, also for lookups in worker processes.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def last_feedback(self, submission):
+        """
+        Returns:
+            str: The last feedback stored for the submission, or None.
+        """
+        with closing(self._connect()) as db:
+            row = db.execute('''SELECT feedback FROM results WHERE assignment IS ? AND userid IS ? AND groupid IS ?
+                                ORDER BY id DESC LIMIT 1''', self._submission_ids(submission)).fetchone()
+        return row['feedback'] if row else None
+
+    def record(self, key, validator, submission, outcome, feedback, duration, cached=False, usage=None):
+        """
+        Add the result of a validation run to the history.
+
+        Args:
+            usage (list): The resources used by the programs of the job, see :meth:`Job.usage_summary`.
+        """
+        with closing(self._connect()) as db, db:
+            db.execute('''INSERT INTO results (key, validator, assignment, userid, groupid, outcome,
+                                               feedback, duration, cached, created, usage)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (key, validator) + self._submission_ids(submission) +
+                       (outcome, feedback, duration, int(cached), time.time(),
+                        json.dumps(usage) if usage is not None else None))
+        logger.debug("Stored validation result for {0}".format(key))
+
+    def history(self, submission=None):
+        """
+        Get all recorded validation runs, optionally only for a single submission.
+
+        Returns:
+            list: One dictionary per run, oldest first.
+        """
+        with closing(self._connect()) as db:
+            if submission:
+                rows = db.execute('SELECT * FROM results WHERE assignment IS ? AND userid IS ? AND groupid IS ? ORDER BY id',
+                                  self._submission_ids(submission)).fetchall()
+            else:
+                rows = db.execute('SELECT * FROM results ORDER BY id').fetchall()
+        result = []
+        for row in rows:
+            run = dict(row)
+            run['usage'] = json.loads(run['usage']) if run['usage'] else None
+            result.append(run)
+        return result
+
+    def stats(self):
+        """
+        Returns:
+            dict: The database file, number of recorded runs, and hit and miss counts.
+        """
+        with closing(self._connect()) as db:
+            runs = db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        return {'path': self.path,
+                'runs': runs,
+                'hits': self.hits,
+                'misses': self.misses}
@@ -0,0 +1,180 @@
+"""
+Retry handling for HTTP requests to the Moodle server.
+"""
+
+import random
+import threading
+import time
+
+import requests
+
+from .exceptions import CircuitOpenException
+
+import logging
+logger = logging.getLogger('moodleteacher')
+
+
+class CircuitBreaker():
+    """
+    A circuit breaker that stops sending requests to a server that is down.
+
+    After `failure_threshold` consecutive failures, the circuit opens and all
+    requests fail fast for `reset_timeout` seconds. Afterwards, a single trial
+    request is let through. Its success closes the circuit again, its failure
+    opens it for another period.
+
+    Attributes:
+        failure_threshold (int): Number of consecutive failures that open the circuit.
+        reset_timeout (float):   Seconds to wait before a trial request is allowed.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Check if a request may be sent to the server right now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                logger.info("Circuit breaker is half-open, sending trial request.")
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit breaker closed, server is responding again.")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.error("Circuit breaker opened after {0} failed requests.".format(self.failures))
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy():
+    """
+    Decides if and when a failed HTTP request is sent again.
+
+    Timeouts, connection errors and 5xx responses are retried with exponential
+    backoff and full jitter, until either `max_attempts` or `max_time` is exhausted.
+
+    Attributes:
+        max_attempts (int):      Maximum number of attempts per request, including the first one.
+        max_time (float):        Maximum number of seconds spent on a request, including waiting.
+        backoff_base (float):    Backoff delay before the first retry, doubled for every further retry.
+        backoff_max (float):     Upper limit for a single backoff delay.
+        jitter (bool):           Randomize the backoff delay, to avoid synchronized retries.
+        circuit_breaker (CircuitBreaker): Circuit breaker for the server, or None.
+    """
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+    def __init__(self, max_attempts=5, max_time=120, backoff_base=0.5, backoff_max=30, jitter=True, circuit_breaker=None):
+        self.max_attempts = max_attempts
+        self.max_time = max_time
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.circuit_breaker = circuit_breaker
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.wait_time = 0.0
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "{requests} requests, {retries} retries, {failures} failures, {wait_time:.1f}s waited".format(**self.stats())
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of requests, retries and failed requests, and the seconds spent waiting for retries.
+        """
+        with self._lock:
+            return {'requests': self.requests,
+                    'retries': self.retries,
+                    'failures': self.failures,
+                    'wait_time': self.wait_time}
+
+    def backoff(self, retry):
+        """
+        Determine the waiting time before the given retry, starting with 1.
+        """
+        delay = min(self.backoff_max, self.backoff_base * (2 ** (retry - 1)))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, perform, description):
+        """
+        Run the given request function according to this policy.
+
+        Args:
+            perform (callable): Sends the request and returns the response object.
+            description (str):  Request description for log messages.
+
+        Returns:
+            The last response. Responses with a 5xx status code are returned
+            when the retry budget is exhausted, so that the caller can raise it.
+
+        Raises:
+            CircuitOpenException: The circuit breaker is open.
+        """
+        with self._lock:
+            self.requests += 1
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if self.circuit_breaker and not self.circuit_breaker.allow_request():
+                with self._lock:
+                    self.failures += 1
+                raise CircuitOpenException("Moodle server seems to be down, not sending {0}.".format(description))
+            attempt += 1
+            response = None
+            try:
+                response = perform()
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                error = e
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    if self.circuit_breaker:
+                        self.circuit_breaker.record_success()
+                    if attempt > 1:
+                        logger.info("{0} succeeded after {1} attempts.".format(description, attempt))
+                    return response
+                error = "status code {0}".format(response.status_code)
+            if self.circuit_breaker:
+                self.circuit_breaker.record_failure()
+
+            delay = self.backoff(attempt)
+            elapsed = time.monotonic() - start
+            if attempt >= self.max_attempts or elapsed + delay > self.max_time:
+                logger.error("{0} failed after {1} attempts and {2:.1f} seconds: {3}".format(
+                    description, attempt, elapsed, error))
+                with self._lock:
+                    self.failures += 1
+                if response is not None:
+                    return response
+                raise error
+            logger.warning("{0} failed ({1}), retrying in {2:.1f} seconds.".format(description, error, delay))
+            with self._lock:
+                self.retries += 1
+                self.wait_time += delay
+            time.sleep(delay)
@@ -1,12 +1,208 @@
 import pexpect
 import os
-import tempfile
+import resource
+import shlex
+import signal
+import subprocess
+import sys
+import threading
+import time
 
 from .exceptions import *
 
 import logging
 logger = logging.getLogger('moodleteacher')
 
+# Default number of output bytes kept for each program
+OUTPUT_LIMIT = 1024 * 1024
+
+
+class ResourceLimits():
+    """Operating system resource limits for a program, see setrlimit(2).
+
+    Limits that are not given are inherited from the parent process.
+    Limits above the hard limits of the parent process are reduced to them.
+
+    Attributes:
+        cpu_time (int):       Maximum CPU time in seconds.
+        address_space (int):  Maximum size of the virtual memory in bytes.
+        file_size (int):      Maximum size of created files in bytes.
+        processes (int):      Maximum number of processes. Note that the operating
+                              system counts all processes of the user.
+        open_files (int):     Maximum number of open file descriptors.
+    """
+
+    def __init__(self, cpu_time=None, address_space=None, file_size=None, processes=None, open_files=None):
+        self.cpu_time = cpu_time
+        self.address_space = address_space
+        self.file_size = file_size
+        self.processes = processes
+        self.open_files = open_files
+
+    def __str__(self):
+        return str(vars(self))
+
+    def apply(self):
+        """Set the limits for the current process.
+
+        Called in the child process before the program is executed.
+        """
+        for limit, value in [(resource.RLIMIT_CPU, self.cpu_time),
+                             (resource.RLIMIT_AS, self.address_space),
+                             (resource.RLIMIT_FSIZE, self.file_size),
+                             (resource.RLIMIT_NPROC, self.processes),
+                             (resource.RLIMIT_NOFILE, self.open_files)]:
+            if value is not None:
+                soft, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.setrlimit(limit, (value, value))
+
+
+class ResourceUsage():
+    """Resources used by a finished program, including all its waited-for children.
+
+    Attributes:
+        wall_time (float):    Elapsed real time in seconds.
+        user_time (float):    CPU time spent in user mode in seconds.
+        system_time (float):  CPU time spent in the operating system kernel in seconds.
+        max_rss (int):        Peak resident memory in bytes.
+    """
+
+    def __init__(self, wall_time, user_time=None, system_time=None, max_rss=None):
+        self.wall_time = wall_time
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss
+
+    @classmethod
+    def from_rusage(cls, wall_time, rusage):
+        # Linux reports kilobytes, macOS bytes
+        max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+        return cls(wall_time, rusage.ru_utime, rusage.ru_stime, max_rss)
+
+    @property
+    def cpu_time(self):
+        if self.user_time is None:
+            return None
+        return self.user_time + self.system_time
+
+    def as_dict(self):
+        return {'wall_time': self.wall_time,
+                'user_time': self.user_time,
+                'system_time': self.system_time,
+                'max_rss': self.max_rss}
+
+    def __str__(self):
+        if self.user_time is None:
+            return "{0:.3f}s wall time".format(self.wall_time)
+        return "{0:.3f}s wall time, {1:.3f}s user, {2:.3f}s system, {3} KB peak memory".format(
+            self.wall_time, self.user_time, self.system_time, self.max_rss // 1024)
+
+
+def _set_wait_status(ptyproc, status):
+    """
+    Store a child status from os.wait4 in a ptyprocess object,
+    the same way as its own wait() would do.
+    """
+    ptyproc.status = status
+    ptyproc.terminated = True
+    if os.WIFSIGNALED(status):
+        ptyproc.exitstatus = None
+        ptyproc.signalstatus = os.WTERMSIG(status)
+    else:
+        ptyproc.exitstatus = os.WEXITSTATUS(status)
+        ptyproc.signalstatus = None
+
+
+# Process groups of the programs started by this process
+_process_groups = set()
+
+
+def _kill_group(pid):
+    """
+    Kill all processes in the process group of a program.
+    """
+    _process_groups.discard(pid)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # Group is already gone
+        pass
+
+
+def kill_all():
+    """
+    Kill all programs started by this process, together with their children.
+    """
+    for pid in list(_process_groups):
+        _kill_group(pid)
+
+
+class OutputBuffer():
+    """A bounded in-memory buffer for program output.
+
+    The buffer keeps the first and the last `limit` / 2 bytes of the output.
+    Everything in between is dropped, and replaced by a marker when reading
+    the output. Text written to the buffer is stored as UTF-8.
+
+    Attributes:
+        limit (int):      The maximum number of stored bytes.
+        omitted (int):    The number of dropped bytes.
+    """
+
+    def __init__(self, limit=None):
+        if not limit:
+            limit = OUTPUT_LIMIT
+        self.limit = limit
+        self.omitted = 0
+        self._head_size = limit // 2
+        self._tail_size = limit - self._head_size
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._head) + self.omitted + len(self._tail)
+
+    @property
+    def truncated(self):
+        return self.omitted > 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self._lock:
+            free = self._head_size - len(self._head)
+            if free > 0:
+                self._head += data[:free]
+                data = data[free:]
+            if not data:
+                return
+            self._tail += data
+            excess = len(self._tail) - self._tail_size
+            if excess > 0:
+                del self._tail[:excess]
+                self.omitted += excess
+
+    def flush(self):
+        # Part of the file interface expected by pexpect
+        pass
+
+    def getvalue(self, encoding=None):
+        """Get the stored output, with a marker for the dropped part.
+
+        Returns:
+            str: The output, decoded with the given encoding or UTF-8.
+        """
+        encoding = encoding if encoding else 'utf-8'
+        with self._lock:
+            text = self._head.decode(encoding, errors='replace')
+            if self.omitted:
+                text += "\n[... {0} bytes of output omitted ...]\n".format(self.omitted)
+            text += self._tail.decode(encoding, errors='replace')
+        return text
+
 
 class RunningProgram():
     """A running program that you can interact with.
@@ -14,14 +210,20 @@ class RunningProgram():
     This class is a thin wrapper around the functionality
     of pexpect (http://pexpect.readthedocs.io/en/stable/overview.html).
 
+    The console output is kept in an :class:`OutputBuffer`. The program
+    runs in its own session, so that :meth:`kill` also terminates all
+    processes started by it.
+
     Attributes:
         name (str):           The name of the binary that is executed.
         working_dir (str):    The working directory to be used during execution.
         arguments (tuple):    The command-line arguments being used for execution.
+        usage (ResourceUsage): The resources used by the program, after :meth:`expect_end`.
     """
     name = None
     arguments = None
     working_dir = None
+    usage = None
     _logfile = None
     _spawn = None
 
@@ -31,11 +233,7 @@ class RunningProgram():
         Returns:
             str: Program output as text. May be incomplete.
         """
-        # Open temporary file for reading, in text mode
-        # This makes sure that the file pointer for writing
-        # is not touched
-        with open(self._logfile.name) as logfile:
-            return '<pre>' + ''.join(logfile.readlines()) + '</pre>'
+        return '<pre>' + self._logfile.getvalue() + '</pre>'
 
     def get_exitstatus(self):
         """Get the exit status of the program execution.
@@ -47,7 +245,7 @@ class RunningProgram():
         logger.debug("Exit status is {0}".format(self._spawn.exitstatus))
         return self._spawn.exitstatus
 
-    def __init__(self, name, arguments=[], working_dir='.', timeout=30, encoding=None):
+    def __init__(self, name, arguments=[], working_dir='.', timeout=30, encoding=None, output_limit=None, limits=None):
         """Initialize a running program.
 
         Args:
@@ -57,11 +255,15 @@ class RunningProgram():
             timeout:  The timeout for program execution.
             encoding: The text encoding for the program output, e.g. 'utf-8'. If this parameter
                     is not set, then the output is interpreted as bytes.
+            output_limit: The maximum number of output bytes kept for :meth:`get_output`,
+                    defaults to OUTPUT_LIMIT.
+            limits: The :class:`ResourceLimits` for the program.
         """
         self.name = name
         self.arguments = arguments
         self.working_dir = working_dir
         self.encoding = encoding
+        self.limits = limits
 
         # Allow code to load its own libraries
         os.environ["LD_LIBRARY_PATH"] = working_dir
@@ -74,18 +276,21 @@ class RunningProgram():
         if name.startswith('./'):
             name = name.replace('./', working_dir)
 
-        self._logfile = tempfile.NamedTemporaryFile(encoding=encoding, mode='w+' if encoding else 'w+b')
-        logger.debug("Keeping console I/O in " + self._logfile.name)
+        self._logfile = OutputBuffer(output_limit)
+        self._started = time.monotonic()
         try:
+            # The pty child process always becomes leader of a new session
             self._spawn = pexpect.spawn(name, arguments,
                                         logfile=self._logfile,
                                         timeout=timeout,
                                         cwd=working_dir,
                                         echo=False,
-                                        encoding=encoding)
+                                        encoding=encoding,
+                                        preexec_fn=limits.apply if limits else None)
         except Exception as e:
             logger.debug("Spawning failed: " + str(e))
             raise NestedException(instance=self, real_exception=e, output=self.get_output())
+        _process_groups.add(self._spawn.pid)
 
     def expect(self, pattern, timeout=-1, searchwindowsize=-1, async_=False, **kw):
         return self._spawn.expect(pattern, timeout, searchwindowsize, async_, **kw)
@@ -152,10 +357,8 @@ class RunningProgram():
         """
         logger.debug("Waiting for termination of '{0}'".format(self.name))
         try:
-            # Make sure we fetch the last output bytes.
-            # Recommendation from the pexpect docs.
-            self._spawn.expect(pexpect.EOF)
-            self._spawn.wait()
+            self._drain()
+            self._wait()
             dircontent = str(os.listdir(self.working_dir))
             logger.debug("Working directory after execution: " + dircontent)
             return self.get_exitstatus(), self.get_output()
@@ -164,11 +367,50 @@ class RunningProgram():
             raise TerminationException(instance=self, real_exception=e, output=self.get_output())
         except pexpect.exceptions.TIMEOUT as e:
             logger.debug("Raising timeout exception.")
+            self.kill()
             raise TimeoutException(instance=self, real_exception=e, output=self.get_output())
         except Exception as e:
             logger.debug("Waiting for expected program end failed.")
             raise NestedException(instance=self, real_exception=e, output=self.get_output())
 
+    def _drain(self):
+        # Read the remaining output until EOF, in order to fetch the last output bytes.
+        # In contrast to expect(pexpect.EOF), the output is not collected in the
+        # pexpect buffer, only the output buffer keeps it.
+        timeout = self._spawn.timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise pexpect.exceptions.TIMEOUT("Program did not end within {0} seconds.".format(timeout))
+            try:
+                self._spawn.read_nonblocking(64 * 1024, timeout=remaining)
+            except pexpect.exceptions.EOF:
+                return
+
+    def _wait(self):
+        ptyproc = self._spawn.ptyproc
+        if not ptyproc.terminated:
+            # Reap the child ourselves, in order to get its resource usage
+            try:
+                pid, status, rusage = os.wait4(self._spawn.pid, 0)
+                self.usage = ResourceUsage.from_rusage(time.monotonic() - self._started, rusage)
+                _set_wait_status(ptyproc, status)
+            except ChildProcessError:
+                # Already reaped by pexpect
+                pass
+        if not self.usage:
+            self.usage = ResourceUsage(time.monotonic() - self._started)
+        self._spawn.wait()
+
+    def kill(self):
+        """Terminate the program, together with all processes started by it."""
+        if self._spawn:
+            _kill_group(self._spawn.pid)
+            self._spawn.close(force=True)
+            if not self.usage:
+                self.usage = ResourceUsage(time.monotonic() - self._started)
+
     def expect_exitstatus(self, exit_status):
         """Wait for the running program to finish and expect some exit status.
 
@@ -179,8 +421,9 @@ class RunningProgram():
             WrongExitStatusException: The produced exit status is not the expected one.
         """
         self.expect_end()
-        logger.debug("Checking exit status of '{0}', output so far: {1}".format(
-            self.name, self.get_output()))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Checking exit status of '{0}', output so far: {1}".format(
+                self.name, self.get_output()))
         if self._spawn.exitstatus is None:
             raise WrongExitStatusException(
                 instance=self, expected=exit_status, output=self.get_output())
@@ -191,3 +434,204 @@ class RunningProgram():
                 expected=exit_status,
                 got=self._spawn.exitstatus,
                 output=self.get_output())
+
+
+class PipedProgram():
+    """A program that runs to completion, without interaction.
+
+    In contrast to :class:`RunningProgram`, no pseudo terminal is allocated.
+    The program reads its standard input from the given data or file,
+    and its standard output and error are captured through a pipe into
+    an :class:`OutputBuffer`. Lines therefore end with '\\n', instead of
+    the '\\r\\n' from a terminal. The program runs in its own session,
+    and all processes started by it are killed when it ends.
+
+    Attributes:
+        name (str):           The name of the binary that is executed.
+        working_dir (str):    The working directory to be used during execution.
+        arguments (tuple):    The command-line arguments being used for execution.
+        exitstatus (int):     The exit status, or None if the program was terminated by a signal.
+        signalstatus (int):   The signal that terminated the program, or None.
+        usage (ResourceUsage): The resources used by the program, after it ended.
+    """
+    name = None
+    arguments = None
+    working_dir = None
+    exitstatus = None
+    signalstatus = None
+    usage = None
+
+    def __init__(self, name, arguments=[], working_dir='.', timeout=30, encoding=None, stdin=None, output_limit=None, limits=None,
+                 output_file=None, output_file_limit=None):
+        """Start a program.
+
+        Args:
+            name:  The file path for the executable. Without arguments, this may also
+                   be a complete command-line.
+            arguments:  The command-line arguments for the executable.
+            working_dir:  The current working directory when running the program.
+            timeout:  The timeout for program execution.
+            encoding: The text encoding for the program input and output, e.g. 'utf-8'.
+            stdin:  The input for the program, as bytes, text or file object.
+                    If not given, the program reads nothing from standard input.
+            output_limit: The maximum number of output bytes kept for :meth:`get_output`,
+                    defaults to OUTPUT_LIMIT.
+            limits: The :class:`ResourceLimits` for the program.
+            output_file: A binary file that receives the complete output, independent of the output limit.
+            output_file_limit: The maximum number of bytes written to output_file, or None for no limit.
+                    If the program produces more, :attr:`output_file_truncated` is set.
+        """
+        self.name = name
+        self.arguments = arguments
+        self.working_dir = working_dir
+        self.timeout = timeout
+        self.encoding = encoding
+        self.limits = limits
+        self._output = OutputBuffer(output_limit)
+        self._output_file = output_file
+        self._output_file_space = output_file_limit
+        self.output_file_truncated = False
+        self._process = None
+        self._ended = threading.Event()
+
+        logger.debug("Running '{0}' in {1} with the following arguments:{2}".format(
+            name,
+            working_dir,
+            str(arguments)))
+
+        # Same behavior as pexpect, which splits the command if no arguments are given
+        cmdline = [name] + list(arguments) if arguments else shlex.split(name)
+        if cmdline[0].startswith('./'):
+            cmdline[0] = os.path.join(working_dir, cmdline[0][2:])
+        # Allow code to load its own libraries
+        env = dict(os.environ, LD_LIBRARY_PATH=working_dir)
+
+        if isinstance(stdin, str):
+            stdin = stdin.encode(encoding if encoding else 'utf-8')
+        data = stdin if isinstance(stdin, (bytes, bytearray)) else None
+        if data is not None:
+            stdin = subprocess.PIPE
+        elif stdin is None:
+            stdin = subprocess.DEVNULL
+        self._started = time.monotonic()
+        try:
+            self._process = subprocess.Popen(cmdline,
+                                             cwd=working_dir,
+                                             env=env,
+                                             stdin=stdin,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT,
+                                             start_new_session=True,
+                                             preexec_fn=limits.apply if limits else None)
+        except Exception as e:
+            logger.debug("Starting failed: " + str(e))
+            raise NestedException(instance=self, real_exception=e, output=self.get_output())
+        _process_groups.add(self._process.pid)
+
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+        threading.Thread(target=self._wait, daemon=True).start()
+        if data is not None:
+            threading.Thread(target=self._write, args=(data,), daemon=True).start()
+
+    def _read(self):
+        fd = self._process.stdout.fileno()
+        for chunk in iter(lambda: os.read(fd, 64 * 1024), b''):
+            self._output.write(chunk)
+            if self._output_file:
+                self._write_output_file(chunk)
+        self._process.stdout.close()
+
+    def _write_output_file(self, chunk):
+        if self._output_file_space is not None:
+            if len(chunk) > self._output_file_space:
+                chunk = chunk[:self._output_file_space]
+                self.output_file_truncated = True
+            self._output_file_space -= len(chunk)
+        self._output_file.write(chunk)
+
+    def _wait(self):
+        # Reap the child ourselves, in order to get its resource usage
+        pid, status, rusage = os.wait4(self._process.pid, 0)
+        self.usage = ResourceUsage.from_rusage(time.monotonic() - self._started, rusage)
+        self._process.returncode = os.waitstatus_to_exitcode(status)
+        self._ended.set()
+
+    def _write(self, data):
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.close()
+        except (BrokenPipeError, OSError):
+            # Program does not read all of its input
+            pass
+
+    def get_output(self):
+        """Get the program output produced so far.
+
+        Returns:
+            str: Program output as text. May be incomplete.
+        """
+        return '<pre>' + self._output.getvalue(self.encoding) + '</pre>'
+
+    def get_exitstatus(self):
+        """Get the exit status of the program execution.
+
+        Returns:
+            int: Exit status as reported by the operating system,
+                 or None if it is not available.
+        """
+        logger.debug("Exit status is {0}".format(self.exitstatus))
+        return self.exitstatus
+
+    def kill(self):
+        """Terminate the program, together with all processes started by it."""
+        if self._process:
+            _kill_group(self._process.pid)
+            self._ended.wait()
+
+    def expect_end(self):
+        """Wait for the program to finish.
+
+        Returns:
+            A tuple with the exit code, as reported by the operating system, and the output produced.
+
+        Raises:
+            TimeoutException: The program did not finish within the timeout.
+        """
+        logger.debug("Waiting for termination of '{0}'".format(self.name))
+        if not self._ended.wait(self.timeout):
+            logger.debug("Raising timeout exception.")
+            self.kill()
+            self._reader.join(1)
+            e = subprocess.TimeoutExpired(self.name, self.timeout)
+            raise TimeoutException(instance=self, real_exception=e, output=self.get_output())
+        returncode = self._process.returncode
+        # Remaining children of the program may still keep the output pipe open
+        _kill_group(self._process.pid)
+        self._reader.join(self.timeout)
+        if returncode < 0:
+            self.signalstatus = -returncode
+        else:
+            self.exitstatus = returncode
+        return self.get_exitstatus(), self.get_output()
+
+    def expect_exitstatus(self, exit_status):
+        """Wait for the program to finish and expect some exit status.
+
+        Args:
+            exit_status (int):  The expected exit status.
+
+        Raises:
+            WrongExitStatusException: The produced exit status is not the expected one.
+        """
+        self.expect_end()
+        if self.exitstatus is None:
+            raise WrongExitStatusException(
+                instance=self, expected=exit_status, output=self.get_output())
+
+        if self.exitstatus != exit_status:
+            raise WrongExitStatusException(
+                instance=self,
+                expected=exit_status,
+                got=self.exitstatus,
+                output=self.get_output())
@@ -0,0 +1,32 @@
+"""
+Helpers for the local caches and stores.
+"""
+
+import sqlite3
+
+CHUNK_SIZE = 64 * 1024
+
+
+def connect(path):
+    """
+    Open a SQLite database for a single operation.
+
+    A fresh database connection per operation keeps the caches and stores
+    usable from several threads and forked worker processes.
+    """
+    db = sqlite3.connect(path, timeout=30)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def update_hash(sha, fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Feed the remaining content of a binary file object into a hash object,
+    without reading it completely into memory.
+
+    Returns:
+        The hash object.
+    """
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        sha.update(chunk)
+    return sha
@@ -1,5 +1,5 @@
 from .requests import MoodleRequest
-from .files import MoodleFile
+from .files import MoodleFile, prefetch_files
 
 import logging
 logger = logging.getLogger('moodleteacher')
@@ -10,6 +10,9 @@ NOT_GRADED = 'notgraded'
 NEW = 'new'
 SUBMITTED = 'submitted'
 
+# Grade value that only updates the feedback
+FEEDBACK_ONLY_GRADE = -99999
+
 
 class MoodleSubmission():
     """
@@ -45,28 +48,48 @@ class MoodleSubmission():
             text += "without notes"
         return(text)
 
-    def parse_plugin_json(self, raw_json):
+    @staticmethod
+    def _parse_plugins(raw_json):
         """
-        Parses a plugin block from Moodle JSON and updates the object
-        accordingly.
+        Parses a plugin block from Moodle JSON.
+
+        Returns:
+            tuple: The list of file information dictionaries and the online text, or None.
         """
-        files = []
+        fileinfos = []
         textfield = None
         for plugin in raw_json:
             if plugin['type'] == 'file':
-                for fileinfo in plugin['fileareas'][0]['files']:
-                    moodle_file = MoodleFile.from_url(
-                        conn=self.conn,
-                        url=fileinfo['fileurl'],
-                        name=fileinfo['filename'],
-                        time_modified=fileinfo['timemodified'],
-                        mime_type=fileinfo['mimetype'])
-                    files.append(moodle_file)
+                fileinfos.extend(plugin['fileareas'][0]['files'])
             elif plugin['type'] == 'onlinetext':
                 textfield = plugin['editorfields'][0]['text']
+        return fileinfos, textfield
+
+    def parse_plugin_json(self, raw_json):
+        """
+        Parses a plugin block from Moodle JSON and updates the object
+        accordingly.
+        """
+        fileinfos, textfield = self._parse_plugins(raw_json)
+        files = []
+        for fileinfo in fileinfos:
+            moodle_file = MoodleFile.from_url(
+                conn=self.conn,
+                url=fileinfo['fileurl'],
+                name=fileinfo['filename'],
+                time_modified=fileinfo['timemodified'],
+                mime_type=fileinfo['mimetype'])
+            files.append(moodle_file)
         self.files = files
         self.textfield = textfield
 
+    def prefetch(self, max_workers=4):
+        """
+        Download the content of all submission files now, in parallel.
+        """
+        prefetch_files(self.files, max_workers)
+        return self
+
     def is_empty(self):
         return len(self.files) == 0 and not self.textfield
 
@@ -104,48 +127,77 @@ class MoodleSubmission():
         See also https://moodle.org/mod/forum/discuss.php?d=384108.
         """
         logger.debug("Saving feedback information only.")
-        self.save_grade(grade=-99999, feedback=feedback)
+        self.save_grade(grade=FEEDBACK_ONLY_GRADE, feedback=feedback)
         return ""
 
     def load_grade(self):
         """
         Loads the grade currently set for this assignment.
+
+        The grade is taken from the grade index of the course, which is
+        fetched for all users at once. See :meth:`MoodleCourse.refresh_grades`.
         """
-        for grade in self.assignment.course.get_user_grades(self.userid):
-            if grade.item_name == self.assignment.name:
-                logger.debug("Existing grade: {}".format(grade.gradeformatted))
-                return grade.gradeformatted
+        grade = self.assignment.course.grade_index.get(self.userid, self.assignment)
+        if grade:
+            logger.debug("Existing grade: {}".format(grade.gradeformatted))
+            return grade.gradeformatted
         return None
 
-    def save_grade(self, grade, feedback=None):
+    def _grade_data(self, grade, feedback=None):
         """
-        Saves new grading information for this student on the Moodle server, and sets the workflow
-        state to "graded".
+        Determines the parameters for a mod_assign_save_grade call, or None
+        if the feedback cannot be saved for this assignment.
         """
         # You can only give text feedback if your assignment is configured accordingly
         if feedback is not None and not self.assignment.allows_feedback_comment:
             logger.error("Could not save feedback, assignment does not allow feedback comments. Please check your assignment settings in Moodle.")
-            return
+            return None
 
         if self.is_group_submission():
             userid = self.get_group_members()[0].id_
         else:
             userid = self.userid
 
-        data = {'assignmentid': self.assignment.id_,
-                  'userid': userid,
-                  'workflowstate': GRADED,
-                  'attemptnumber': -1,
-                  'addattempt': int(True),
-                  'grade': float(grade) if grade else '',
-                  # always apply grading to team
-                  # if the assignment has no group submission, this has no effect.
-                  'applytoall': int(True),
-                  'plugindata[assignfeedbackcomments_editor][text]': str(feedback) if feedback else "",
-                  # //content format (1 = HTML, 0 = MOODLE, 2 = PLAIN or 4 = MARKDOWN)
-                  'plugindata[assignfeedbackcomments_editor][format]': 1
-                  }
+        return {'assignmentid': self.assignment.id_,
+                'userid': userid,
+                'workflowstate': GRADED,
+                'attemptnumber': -1,
+                'addattempt': int(True),
+                'grade': float(grade) if grade else '',
+                # always apply grading to team
+                # if the assignment has no group submission, this has no effect.
+                'applytoall': int(True),
+                'plugindata[assignfeedbackcomments_editor][text]': str(feedback) if feedback else "",
+                # //content format (1 = HTML, 0 = MOODLE, 2 = PLAIN or 4 = MARKDOWN)
+                'plugindata[assignfeedbackcomments_editor][format]': 1
+                }
+
+    def save_grade(self, grade, feedback=None):
+        """
+        Saves new grading information for this student on the Moodle server, and sets the workflow
+        state to "graded".
+        """
+        data = self._grade_data(grade, feedback)
+        if data is None:
+            return
 
         response = MoodleRequest(
             self.conn, 'mod_assign_save_grade').post(data=data).json()
         logger.debug("Response from grading update: {0}".format(response))
+        self._update_grade_index(grade)
+
+    def _update_grade_index(self, grade):
+        """
+        Updates the grade index of the course after a successful save, so that
+        :meth:`is_graded` sees the new grade. The grade is applied to the whole
+        team, so all group members are updated.
+        """
+        if grade == FEEDBACK_ONLY_GRADE:
+            # The grade itself stays unchanged
+            return
+        course = self.assignment.course
+        if self.groupid:
+            user_ids = course.group_members[self.groupid]
+        else:
+            user_ids = [self.userid]
+        course.update_grades(user_ids, self.assignment, "{0:.2f}".format(float(grade)) if grade else "-")
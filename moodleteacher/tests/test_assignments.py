@@ -0,0 +1,192 @@
+from moodleteacher.connection import MoodleConnection
+from moodleteacher.courses import MoodleCourse
+from moodleteacher.assignments import MoodleAssignment
+from moodleteacher.submissions import MoodleSubmission
+from moodleteacher.grades import MoodleGradeWriter
+from moodleteacher.journal import GradeJournal
+from moodleteacher.retry import RetryPolicy
+import json
+import requests
+import tempfile
+import time
+import responses
+import re
+
+
+def _file_plugins(userid):
+    return [{'type': 'file',
+             'fileareas': [{'files': [{'fileurl': 'https://simulated_host/pluginfile.php/{0}/hello.c'.format(userid),
+                                       'filename': 'hello.c',
+                                       'timemodified': 1000,
+                                       'mimetype': 'text/plain'}]}]},
+            {'type': 'onlinetext',
+             'editorfields': [{'text': 'Notes by {0}'.format(userid)}]}]
+
+
+def _prepare_course(users=[]):
+    responses.add(responses.POST, re.compile('(.*)core_course_get_user_administration_options(.*)'),
+                  json={'courses': [{'id': 1, 'options': [{'name': 'gradebook', 'available': True}]}]})
+    responses.add(responses.POST, re.compile('(.*)core_enrol_get_enrolled_users(.*)'), json=users)
+    responses.add(responses.GET, re.compile('(.*)pluginfile.php(.*)'), body=b'int main() {}',
+                  content_type='text/plain')
+    conn = MoodleConnection("https://simulated_host", "simulatedtoken")
+    return MoodleCourse(conn=conn, course_id=1)
+
+
+@responses.activate
+def test_submissions_from_bulk_response():
+    course = _prepare_course()
+    bulk = [{'id': userid * 10, 'userid': userid, 'groupid': 0, 'status': 'submitted',
+             'gradingstatus': 'notgraded', 'plugins': _file_plugins(userid)} for userid in range(1, 4)]
+    # team submission, needs a separate request
+    bulk.append({'id': 40, 'userid': 4, 'groupid': 7, 'status': 'submitted'})
+    responses.add(responses.POST, re.compile('(.*)mod_assign_get_submissions(.*)'),
+                  json={'assignments': [{'assignmentid': 1, 'submissions': bulk}]})
+    responses.add(responses.GET, re.compile('(.*)mod_assign_get_submission_status(.*)'),
+                  json={'lastattempt': {'submission': {'id': 40, 'userid': 4, 'status': 'submitted',
+                                                       'plugins': _file_plugins(4)}}})
+
+    assignment = MoodleAssignment(course=course, assignment_id=1)
+    submissions = assignment.submissions()
+    assert([sub.userid for sub in submissions] == [1, 2, 3, 4])
+    assert(submissions[0].textfield == 'Notes by 1')
+    assert(submissions[0].files[0].name == 'hello.c')
+    # File content is only downloaded on demand
+    download_calls = [call for call in responses.calls if 'pluginfile.php' in call.request.url]
+    assert(len(download_calls) == 0)
+    assert(submissions[0].files[0].content == b'int main() {}')
+    status_calls = [call for call in responses.calls if 'mod_assign_get_submission_status' in call.request.url]
+    assert(len(status_calls) == 1)
+
+    submissions = assignment.iter_submissions(prefetch=2)
+    first = next(submissions)
+    assert(first.userid == 1)
+    assert(first.files[0].is_downloaded)
+    assert([sub.userid for sub in submissions] == [2, 3, 4])
+
+
+@responses.activate
+def test_grade_index():
+    course = _prepare_course()
+    usergrades = [{'courseid': 1, 'userid': userid,
+                   'gradeitems': [{'id': 5, 'itemname': 'Task 1', 'cmid': 42,
+                                   'gradeformatted': '5.00' if userid == 1 else '-'},
+                                  {'id': 6, 'itemname': 'Course total', 'gradeformatted': '5.00'}]}
+                  for userid in range(1, 4)]
+    responses.add(responses.POST, re.compile('(.*)gradereport_user_get_grade_items(.*)'),
+                  json={'usergrades': usergrades})
+    responses.add(responses.POST, re.compile('(.*)mod_assign_get_grades(.*)'),
+                  json={'assignments': [{'assignmentid': 1,
+                                         'grades': [{'id': 9, 'userid': 2, 'grade': '3.50000'}]}]})
+    assignment = MoodleAssignment(course=course, assignment_id=1, course_module_id=42, name='Task 1')
+    submissions = [MoodleSubmission(conn=course.conn, assignment=assignment, user_id=userid) for userid in range(1, 4)]
+    assert([sub.is_graded() for sub in submissions] == [True, False, False])
+    assert(len([call for call in responses.calls if 'gradereport_user_get_grade_items' in call.request.url]) == 1)
+    course.grade_index.refresh_assignments([assignment])
+    assert(submissions[1].load_grade() == '3.50')
+
+
+@responses.activate
+def test_grade_index_after_save():
+    team = [{'id': userid, 'fullname': 'User {0}'.format(userid), 'groups': [{'id': 7, 'name': 'Team'}]}
+            for userid in (2, 3)]
+    course = _prepare_course(team)
+    responses.add(responses.POST, re.compile('(.*)gradereport_user_get_grade_items(.*)'),
+                  json={'usergrades': [{'courseid': 1, 'userid': userid,
+                                        'gradeitems': [{'id': 5, 'itemname': 'Task 1', 'cmid': 42,
+                                                        'gradeformatted': '-'}]} for userid in (1, 2, 3)]})
+    responses.add(responses.POST, re.compile('(.*)mod_assign_save_grade(.*)'), json=[])
+    assignment = MoodleAssignment(course=course, assignment_id=1, course_module_id=42, name='Task 1',
+                                  allows_feedback_comment=True)
+    single = MoodleSubmission(conn=course.conn, assignment=assignment, user_id=1)
+    group = MoodleSubmission(conn=course.conn, assignment=assignment, user_id=0, group_id=7)
+    members = [MoodleSubmission(conn=course.conn, assignment=assignment, user_id=userid) for userid in (2, 3)]
+    assert(not any(sub.is_graded() for sub in [single] + members))
+    single.save_feedback("Feedback only")
+    assert(not single.is_graded())
+    single.save_grade(4)
+    assert(single.load_grade() == '4.00')
+    # The grade is applied to all team members
+    group.save_grade(2.5)
+    assert([sub.load_grade() for sub in members] == ['2.50', '2.50'])
+    assert(len([call for call in responses.calls if 'gradereport_user_get_grade_items' in call.request.url]) == 1)
+
+
+@responses.activate
+def test_batched_grade_writer():
+    course = _prepare_course()
+    saved = []
+
+    def _save_grades(request):
+        # Moodle rejects the chunk that contains user 13
+        if 'grades%5B3%5D%5Buserid%5D=13' in request.body:
+            return (200, {}, json.dumps({'exception': 'invalid_parameter_exception', 'message': 'Invalid user'}))
+        saved.append(request.body)
+        return (200, {}, 'null')
+
+    def _save_grade(request):
+        if 'userid=13' in request.body:
+            return (200, {}, json.dumps({'exception': 'invalid_parameter_exception', 'message': 'Invalid user'}))
+        return (200, {}, 'null')
+
+    responses.add_callback(responses.POST, re.compile('(.*)mod_assign_save_grades(.*)'), callback=_save_grades)
+    responses.add_callback(responses.POST, re.compile('(.*)mod_assign_save_grade&(.*)'), callback=_save_grade)
+    assignment = MoodleAssignment(course=course, assignment_id=1, allows_feedback_comment=True)
+    with MoodleGradeWriter(course.conn, chunk_size=4) as writer:
+        for userid in range(10, 20):
+            sub = MoodleSubmission(conn=course.conn, assignment=assignment, user_id=userid)
+            writer.add(sub, 1.0, "Feedback for {0}".format(userid))
+    assert(len(saved) == 2)
+    assert(len(writer.results) == 10)
+    assert([result.data['userid'] for result in writer.failed()] == [13])
+
+
+def _pending_updates(conn, path):
+    with GradeJournal(conn, path, autostart=False) as journal:
+        return len(journal)
+
+
+@responses.activate
+def test_grade_journal():
+    course = _prepare_course()
+    assignment = MoodleAssignment(course=course, assignment_id=1, allows_feedback_comment=True)
+    with tempfile.TemporaryDirectory() as journal_dir:
+        path = journal_dir + '/grades.journal'
+        # Process stops before anything was sent
+        journal = GradeJournal(course.conn, path, autostart=False)
+        for userid in range(10, 13):
+            journal.add_feedback(MoodleSubmission(conn=course.conn, assignment=assignment, user_id=userid), "Fine")
+        journal.close()
+        # Restarted process, Moodle is down for the first request
+        course.conn.retry_policy = RetryPolicy(max_attempts=1)
+        responses.add(responses.POST, re.compile('(.*)mod_assign_save_grade&(.*)'),
+                      body=requests.exceptions.ConnectionError())
+        responses.add(responses.POST, re.compile('(.*)mod_assign_save_grade&(.*)'), body='null')
+        with GradeJournal(course.conn, path, retry_delay=0.01) as journal:
+            assert(len(journal) == 3)
+            assert(journal.flush(timeout=10))
+            assert(journal.sent == 3)
+        assert(_pending_updates(course.conn, path) == 0)
+        # Moodle stays down, closing the journal keeps the update for the next run
+        responses.reset()
+        responses.add(responses.POST, re.compile('(.*)mod_assign_save_grade&(.*)'),
+                      body=requests.exceptions.ConnectionError())
+        started = time.monotonic()
+        with GradeJournal(course.conn, path, retry_delay=0.01) as journal:
+            journal.add_feedback(MoodleSubmission(conn=course.conn, assignment=assignment, user_id=10), "Fine")
+            journal.close(timeout=0.5)
+        assert(time.monotonic() - started < 5)
+        assert(_pending_updates(course.conn, path) == 1)
+        # Moodle hangs, closing the journal does not wait for the running request
+        responses.reset()
+
+        def _hanging_save_grade(request):
+            time.sleep(2)
+            return (200, {}, 'null')
+        responses.add_callback(responses.POST, re.compile('(.*)mod_assign_save_grade&(.*)'),
+                               callback=_hanging_save_grade)
+        started = time.monotonic()
+        with GradeJournal(course.conn, path) as journal:
+            journal.close(timeout=0.5)
+        assert(time.monotonic() - started < 1.5)
+        assert(_pending_updates(course.conn, path) == 1)
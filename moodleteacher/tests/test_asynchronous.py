@@ -0,0 +1,54 @@
+from moodleteacher.connection import MoodleConnection
+from moodleteacher.courses import MoodleCourse
+from moodleteacher.assignments import MoodleAssignment
+from moodleteacher.asynchronous import AsyncMoodleConnection
+from urllib.parse import urlparse, parse_qs
+import asyncio
+import json
+import responses
+import re
+
+
+def _submission_status(request):
+    userid = int(parse_qs(urlparse(request.url).query)['userid'][0])
+    plugins = [{'type': 'file',
+                'fileareas': [{'files': [{'fileurl': 'https://simulated_host/pluginfile.php/{0}/hello.c'.format(userid),
+                                          'filename': 'hello.c',
+                                          'timemodified': 1000,
+                                          'mimetype': 'text/plain'}]}]}]
+    answer = {'lastattempt': {'submission': {'id': userid * 10,
+                                             'userid': userid,
+                                             'status': 'submitted',
+                                             'plugins': plugins}}}
+    return (200, {}, json.dumps(answer))
+
+
+@responses.activate
+def test_async_submissions():
+    responses.add(responses.POST, re.compile('(.*)core_course_get_user_administration_options(.*)'),
+                  json={'courses': [{'id': 1, 'options': [{'name': 'gradebook', 'available': True}]}]})
+    responses.add(responses.POST, re.compile('(.*)core_enrol_get_enrolled_users(.*)'), json=[])
+    responses.add(responses.POST, re.compile('(.*)mod_assign_get_submissions(.*)'),
+                  json={'assignments': [{'assignmentid': 1,
+                                         'submissions': [{'userid': userid} for userid in range(1, 6)]}]})
+    responses.add_callback(responses.GET, re.compile('(.*)mod_assign_get_submission_status(.*)'),
+                           callback=_submission_status)
+    responses.add(responses.GET, re.compile('(.*)pluginfile.php(.*)'), body=b'int main() {}',
+                  content_type='text/plain')
+    responses.add(responses.POST, re.compile('(.*)mod_assign_save_grade(.*)'), json={})
+
+    conn = MoodleConnection("https://simulated_host", "simulatedtoken")
+    course = MoodleCourse(conn=conn, course_id=1)
+    assignment = MoodleAssignment(course=course, assignment_id=1, allows_feedback_comment=True)
+
+    async def run():
+        async with AsyncMoodleConnection(conn, max_concurrency=4) as aconn:
+            submissions = await aconn.submissions(assignment)
+            await asyncio.gather(*[aconn.save_grade(sub, 1.0, "Fine") for sub in submissions])
+            return submissions
+
+    submissions = asyncio.run(run())
+    assert(sorted(sub.userid for sub in submissions) == [1, 2, 3, 4, 5])
+    for sub in submissions:
+        assert(sub.files[0].content == b'int main() {}')
+    assert(len([call for call in responses.calls if 'mod_assign_save_grade' in call.request.url]) == 5)
@@ -0,0 +1,52 @@
+from moodleteacher import compare
+from io import BytesIO
+import time
+
+
+def test_exact():
+    assert(compare.compare(b'1\n2\n3\n', BytesIO(b'1\n2\n3\n')))
+    result = compare.compare(b'1\n2\n3\n', b'1\n2\n4\n')
+    assert(not result)
+    assert((result.line, result.expected, result.actual) == (3, b'3', b'4'))
+    result = compare.compare('a\nb\n', 'a\nb\nc\n')
+    assert((result.line, result.expected, result.actual) == (3, None, b'c'))
+    assert(not compare.compare(b'1 2\n', b'1  2\n'))
+
+
+def test_chunks():
+    old_chunk_size = compare.CHUNK_SIZE
+    compare.CHUNK_SIZE = 4
+    try:
+        expected = b'hello world\n' * 5 + b'12.5 the end\n'
+        assert(compare.compare(expected, expected))
+        result = compare.compare(expected, expected.replace(b'end', b'fin'))
+        assert((result.line, result.expected, result.actual) == (6, b'end', b'fin'))
+        result = compare.compare(expected, b'hello   world ' * 5 + b'12.5 the fin', compare.WHITESPACE)
+        assert((result.line, result.expected, result.actual) == (6, b'end', b'fin'))
+        assert(compare.compare(expected, b'hello\tworld\n\n' * 5 + b'12.5 the end', compare.WHITESPACE))
+        assert(compare.compare(expected, b'hello world ' * 5 + b'12.5000001 the end', compare.NUMERIC))
+    finally:
+        compare.CHUNK_SIZE = old_chunk_size
+
+
+def test_numeric():
+    assert(compare.compare(b'0.333333 1e3\n', b'0.3333333 1000\n', compare.NUMERIC, tolerance=1e-5))
+    assert(not compare.compare(b'0.33\n', b'0.34\n', compare.NUMERIC, tolerance=1e-5))
+    assert(not compare.compare(b'1.0 x\n', b'1.0 y\n', compare.NUMERIC))
+    assert(not compare.compare(b'1.0\n', b'1.0 2.0\n', compare.NUMERIC))
+    try:
+        compare.compare(b'', b'', 'fuzzy')
+        assert(False)
+    except ValueError:
+        pass
+
+
+def test_long_tokens():
+    # Tokens across many chunks are found in linear time
+    number = b'1' * (compare.CHUNK_SIZE * 8 + 3)
+    started = time.monotonic()
+    assert(compare.compare(number + b' b\n', number + b'  b', compare.WHITESPACE))
+    assert(compare.compare(number + b'.5\n', number + b'.5', compare.NUMERIC))
+    result = compare.compare(b'a ' + number + b'\nc\n', b'a ' + number + b'2\nc\n', compare.WHITESPACE)
+    assert((result.line, result.expected, result.actual) == (1, number, number + b'2'))
+    assert(time.monotonic() - started < 5)
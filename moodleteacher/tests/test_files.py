@@ -0,0 +1,80 @@
+from moodleteacher.connection import MoodleConnection
+from moodleteacher.files import MoodleFile, sniff_content_type
+from moodleteacher.cache import DownloadCache
+from io import BytesIO
+import os
+import responses
+import tempfile
+import zipfile
+
+
+def _zip_content():
+    data = BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr('src/hello.c', 'int main() { return 0; }')
+        archive.writestr('README', 'x' * 4096)
+    return data.getvalue()
+
+
+@responses.activate
+def test_spooled_download():
+    content = _zip_content()
+    responses.add(responses.GET, 'https://simulated_host/pluginfile.php/1/packed.zip',
+                  body=content, content_type='application/zip')
+    conn = MoodleConnection("https://simulated_host", "simulatedtoken")
+    old_threshold = MoodleFile.SPOOL_THRESHOLD
+    MoodleFile.SPOOL_THRESHOLD = 1024
+    try:
+        f = MoodleFile.from_url(conn, 'https://simulated_host/pluginfile.php/1/packed.zip')
+        f.prefetch()
+        assert(f._content is None)
+        assert(f._spool is not None)
+        assert(f.size == len(content))
+        assert(f.is_zip)
+        with tempfile.TemporaryDirectory() as target_dir:
+            f.unpack_to(target_dir + os.sep, remove_directories=True)
+            assert(sorted(os.listdir(target_dir)) == ['README', 'hello.c'])
+            f.save_as(target_dir + os.sep, 'copy.zip')
+            with open(target_dir + os.sep + 'copy.zip', 'rb') as copy:
+                assert(copy.read() == content)
+        assert(f.content == content)
+    finally:
+        MoodleFile.SPOOL_THRESHOLD = old_threshold
+
+
+@responses.activate
+def test_download_cache():
+    responses.add(responses.GET, 'https://simulated_host/pluginfile.php/1/a.txt',
+                  body=b'a' * 600, content_type='text/plain')
+    responses.add(responses.GET, 'https://simulated_host/pluginfile.php/1/b.txt',
+                  body=b'b' * 600, content_type='text/plain')
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = DownloadCache(cache_dir, max_size=1000)
+        conn = MoodleConnection("https://simulated_host", "simulatedtoken", download_cache=cache)
+        for i in range(2):
+            f = MoodleFile.from_url(conn, 'https://simulated_host/pluginfile.php/1/a.txt', time_modified=1000)
+            assert(f.content == b'a' * 600)
+        assert(len(responses.calls) == 1)
+        assert(cache.hits == 1 and cache.misses == 1)
+        # Same URL, new modification time stamp
+        f = MoodleFile.from_url(conn, 'https://simulated_host/pluginfile.php/1/a.txt', time_modified=2000)
+        assert(f.content == b'a' * 600)
+        assert(len(responses.calls) == 2)
+        # Exceeds the size limit, oldest entries are evicted
+        f = MoodleFile.from_url(conn, 'https://simulated_host/pluginfile.php/1/b.txt', time_modified=1000)
+        assert(f.content == b'b' * 600)
+        stats = cache.stats()
+        assert(stats['evictions'] == 2)
+        assert(stats['entries'] == 1)
+        assert(stats['size'] == 600)
+
+
+def test_content_sniffing():
+    assert(MoodleFile.from_local_data('packed', _zip_content(), None).content_type == 'application/zip')
+    assert(sniff_content_type(b'%PDF-1.4 ...', 'report') == 'application/pdf')
+    assert(sniff_content_type(b'\x7fELF\x02\x01', 'a.out') == 'application/x-executable')
+    assert(sniff_content_type(b'\x00' * 257 + b'ustar' + b'\x00' * 250, 'packed') == 'application/x-tar')
+    assert(sniff_content_type(b'int main() {}', 'hello.c') == 'text/x-csrc')
+    assert(sniff_content_type('Möhre'.encode('utf-8')[:2], 'Makefile') == 'text/plain')
+    assert(sniff_content_type(b'\xef\xbb\xbfall:', 'Makefile') == 'text/plain')
+    assert(sniff_content_type(b'\x00\x01\x02', 'data') == 'application/octet-stream')
@@ -0,0 +1,53 @@
+from moodleteacher.connection import MoodleConnection
+from moodleteacher.requests import MoodleRequest
+from moodleteacher.retry import RetryPolicy, CircuitBreaker
+from moodleteacher.exceptions import CircuitOpenException
+import requests
+import responses
+import re
+
+
+@responses.activate
+def test_pooled_session():
+    responses.add(responses.POST, re.compile('(.*)core_webservice_get_site_info(.*)'), json={'sitename': 'Test'})
+    conn = MoodleConnection("https://simulated_host", "simulatedtoken", pool_size=4)
+    adapter = conn.session.get_adapter("https://simulated_host")
+    assert(adapter._pool_maxsize == 4)
+    for i in range(3):
+        result = MoodleRequest(conn, 'core_webservice_get_site_info').post().json()
+        assert(result['sitename'] == 'Test')
+    assert(len(responses.calls) == 3)
+    conn.close()
+
+
+@responses.activate
+def test_retry_on_server_error():
+    responses.add(responses.POST, re.compile('(.*)core_webservice_get_site_info(.*)'), status=503)
+    responses.add(responses.POST, re.compile('(.*)core_webservice_get_site_info(.*)'), json={'sitename': 'Test'})
+    policy = RetryPolicy(backoff_base=0)
+    conn = MoodleConnection("https://simulated_host", "simulatedtoken", retry_policy=policy)
+    result = MoodleRequest(conn, 'core_webservice_get_site_info').post().json()
+    assert(result['sitename'] == 'Test')
+    assert(policy.stats()['retries'] == 1)
+    assert(policy.stats()['failures'] == 0)
+
+
+@responses.activate
+def test_retry_budget_and_circuit_breaker():
+    responses.add(responses.POST, re.compile('(.*)core_webservice_get_site_info(.*)'), status=500)
+    policy = RetryPolicy(max_attempts=3, backoff_base=0,
+                         circuit_breaker=CircuitBreaker(failure_threshold=3, reset_timeout=60))
+    conn = MoodleConnection("https://simulated_host", "simulatedtoken", retry_policy=policy)
+    try:
+        MoodleRequest(conn, 'core_webservice_get_site_info').post()
+        assert(False)
+    except requests.exceptions.HTTPError:
+        pass
+    assert(len(responses.calls) == 3)
+    try:
+        MoodleRequest(conn, 'core_webservice_get_site_info').post()
+        assert(False)
+    except CircuitOpenException:
+        pass
+    assert(len(responses.calls) == 3)
+    assert(policy.stats()['failures'] == 2)
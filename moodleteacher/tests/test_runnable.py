@@ -0,0 +1,98 @@
+from moodleteacher.runnable import PipedProgram, RunningProgram, OutputBuffer, ResourceLimits
+from moodleteacher.exceptions import TimeoutException, WrongExitStatusException
+import os
+import tempfile
+import time
+
+
+def test_piped_program():
+    assert(PipedProgram('echo hello world').expect_end() == (0, '<pre>hello world\n</pre>'))
+    prog = PipedProgram('cat', [], stdin='Möhre', encoding='utf-8')
+    assert(prog.expect_end() == (0, '<pre>Möhre</pre>'))
+    with tempfile.TemporaryFile() as input_file:
+        input_file.write(b'1\n2\n3\n')
+        input_file.seek(0)
+        assert(PipedProgram('wc', ['-l'], stdin=input_file).expect_end()[1] == '<pre>3\n</pre>')
+    try:
+        PipedProgram('false').expect_exitstatus(0)
+        assert(False)
+    except WrongExitStatusException as e:
+        assert(e.got == 1)
+
+
+def test_piped_program_limits():
+    try:
+        PipedProgram('sleep', ['10'], timeout=0.2).expect_end()
+        assert(False)
+    except TimeoutException:
+        pass
+    try:
+        PipedProgram('yes', ['x'], timeout=0.5, output_limit=100).expect_end()
+        assert(False)
+    except TimeoutException as e:
+        output = e.output
+    assert(output.startswith('<pre>x\nx\n') and output.endswith('x\nx\n</pre>'))
+    assert('bytes of output omitted' in output)
+    assert(len(output) < 200)
+
+
+def test_output_buffer():
+    buffer = OutputBuffer(10)
+    for i in range(10):
+        buffer.write(str(i))
+    assert(buffer.getvalue() == '0123456789' and not buffer.truncated)
+    buffer.write(b'abcdefgh')
+    assert(buffer.truncated and buffer.omitted == 8 and len(buffer) == 18)
+    assert(buffer.getvalue() == '01234\n[... 8 bytes of output omitted ...]\ndefgh')
+
+
+def test_running_program_output():
+    prog = RunningProgram('yes', ['Möhre'], timeout=0.5, encoding='utf-8', output_limit=1000)
+    try:
+        prog.expect_end()
+        assert(False)
+    except TimeoutException:
+        pass
+    assert(prog._logfile.truncated)
+    assert(len(prog.get_output()) < 1100)
+    # Large output of a finished program is only kept in the output buffer
+    prog = RunningProgram('sh', ['-c', 'head -c 1000000 /dev/zero | tr "\\0" x; echo END'], timeout=10,
+                          encoding='utf-8', output_limit=1000)
+    exitstatus, output = prog.expect_end()
+    assert(exitstatus == 0 and output.endswith('END\r\n</pre>'))
+    assert(len(prog._spawn.buffer) == 0 and len(prog._spawn.before or '') == 0)
+
+
+def test_process_group_kill():
+    # The background process would keep running after the shell has ended
+    prog = RunningProgram('sh', ['-c', 'sleep 30 & echo $!; sleep 30'], timeout=0.5, encoding='utf-8')
+    prog.expect_output(r'\d+')
+    child = int(prog._spawn.after)
+    try:
+        prog.expect_end()
+        assert(False)
+    except TimeoutException:
+        pass
+    time.sleep(0.1)
+    assert(not os.path.exists('/proc/{0}'.format(child)) or open('/proc/{0}/stat'.format(child)).read().split()[2] == 'Z')
+
+
+def test_resource_limits():
+    limits = ResourceLimits(cpu_time=1, file_size=1000)
+    exit_code, output = PipedProgram('sh', ['-c', 'while true; do :; done'], timeout=10, limits=limits).expect_end()
+    assert(exit_code is None)
+    with tempfile.TemporaryDirectory() as working_dir:
+        PipedProgram('sh', ['-c', 'head -c 5000 /dev/zero > big'], working_dir=working_dir, limits=limits).expect_end()
+        assert(os.path.getsize(working_dir + os.sep + 'big') == 1000)
+
+
+def test_resource_usage():
+    prog = PipedProgram('python3', ['-c', 'x = bytearray(64 * 1024 * 1024); sum(range(3000000))'])
+    prog.expect_exitstatus(0)
+    assert(prog.usage.cpu_time > 0)
+    assert(prog.usage.max_rss > 64 * 1024 * 1024)
+    assert(prog.usage.wall_time >= prog.usage.user_time / 2)
+    prog = RunningProgram('python3', ['-c', 'sum(range(3000000))'], '.', 30, None)
+    prog.expect_exitstatus(0)
+    assert(prog.usage.cpu_time > 0)
+    assert(prog.usage.max_rss > 0)
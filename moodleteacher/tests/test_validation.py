@@ -1,13 +1,41 @@
 from moodleteacher.submissions import MoodleSubmission
 from moodleteacher.assignments import MoodleAssignment
 from moodleteacher.courses import MoodleCourse
-from moodleteacher.validation import Job
+from moodleteacher.validation import Job, ValidationPool, ValidationResult, _copy_tree
 from moodleteacher.files import MoodleFile
+from moodleteacher.results import ResultStore
+from moodleteacher.compiler import CompilerCache, GCC
+from moodleteacher import compare
+from moodleteacher.exceptions import WrongExitStatusException, TimeoutException
 from moodleteacher.connection import MoodleConnection
+import moodleteacher.validation
+from io import BytesIO
 import os
 import logging
+import shutil
+import stat
+import tempfile
+import time
+import zipfile
 import responses
 import re
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def validator_cache_dir(tmp_path, monkeypatch):
+    """
+    Keeps the unpacked validators of the tests out of the user cache directory.
+    """
+    cache_dir = str(tmp_path / 'validators')
+    monkeypatch.setattr(moodleteacher.validation, 'VALIDATOR_CACHE_DIR', cache_dir)
+    return cache_dir
+
+
+def _prepare_assignment():
+    conn = MoodleConnection(is_fake=True)
+    course = MoodleCourse(conn=conn, course_id=1)
+    return MoodleAssignment(course=course, assignment_id=1, allows_feedback_comment=True)
 
 
 @responses.activate
@@ -186,3 +214,369 @@ def test_regression_001():
 
 def test_regression_003():
     _test_validation_case('regression_003', 'Kniffel.java')
+
+
+class _CollectingWriter():
+    def __init__(self):
+        self.feedback = {}
+
+    def add_feedback(self, submission, feedback):
+        self.feedback[submission.userid] = feedback
+
+
+def test_validation_pool():
+    base_dir = os.path.dirname(__file__) + '/submfiles/validation/'
+    assignment = _prepare_assignment()
+    writer = _CollectingWriter()
+    jobs = []
+    for userid, (directory, student_file) in enumerate([('1000fff', 'helloworld.c'),
+                                                        ('0100fff', 'python.pdf'),
+                                                        ('1000tff', 'packed.zip')]):
+        submission = MoodleSubmission.from_local_file(assignment=assignment,
+                                                      fpath=base_dir + directory + os.sep + student_file)
+        submission.userid = userid
+        validator = MoodleFile.from_local_file(base_dir + directory + os.sep + 'validator.py')
+        jobs.append(Job(submission, validator, "Pool run: ", grade_writer=writer))
+    hanging = MoodleSubmission.from_local_file(assignment=assignment, fpath=base_dir + '1000fff/helloworld.c')
+    hanging.userid = 10
+    jobs.append(Job(hanging, MoodleFile.from_local_data('validator.py', b'import time\ndef validate(job):\n    time.sleep(60)\n', 'text/x-python'),
+                    "Pool run: ", grade_writer=writer))
+    broken = MoodleSubmission.from_local_file(assignment=assignment, fpath=base_dir + '1000fff/helloworld.c')
+    broken.userid = 11
+    jobs.append(Job(broken, MoodleFile.from_local_data('validator.py', b'def validate(job):\n    assert(False)\n', 'text/x-python'),
+                    "Pool run: ", grade_writer=writer))
+
+    results = ValidationPool(workers=3, timeout=5).run(jobs)
+    assert([result.status for result in results] == [ValidationResult.FINISHED] * 3 + [ValidationResult.TIMEOUT, ValidationResult.CRASHED])
+    assert(writer.feedback[0].startswith("Pool run: We saw the following console interaction"))
+    assert(writer.feedback[10] == "Pool run: " + ValidationPool.TIMEOUT_FEEDBACK)
+    assert(11 not in writer.feedback)
+    assert(len(writer.feedback) == 4)
+    assert(results[0].usage and all(program['wall_time'] > 0 for program in results[0].usage))
+
+
+def test_pool_reload_per_job():
+    assignment = _prepare_assignment()
+    with tempfile.TemporaryDirectory() as marker_dir:
+        script = 'import os\nRELOAD_PER_JOB = True\nopen({0!r} + str(os.getpid()), "w").close()\n' \
+                 'def validate(job):\n    pass\n'.format(marker_dir + os.sep)
+        jobs = [Job(MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=userid),
+                    MoodleFile.from_local_data('validator.py', script.encode(), 'text/x-python'), "")
+                for userid in range(2)]
+        results = ValidationPool(workers=2, timeout=30).run(jobs)
+        assert(all(result.success for result in results))
+        # Loaded in each worker, never in the pool process
+        assert(len(os.listdir(marker_dir)) == 2)
+        assert(str(os.getpid()) not in os.listdir(marker_dir))
+
+
+def test_validator_loaded_once():
+    assignment = _prepare_assignment()
+    submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1)
+    script = b'import uuid\nloaded = uuid.uuid4()\ndef validate(job):\n    pass\n'
+    first = Job(submission, MoodleFile.from_local_data('validator.py', script, 'text/x-python'), "")
+    second = Job(submission, MoodleFile.from_local_data('validator.py', script, 'text/x-python'), "")
+    assert(first.load_validator() is second.load_validator())
+    assert(first.load_validator().__name__.startswith('validator_'))
+    script += b'RELOAD_PER_JOB = True\n'
+    first = Job(submission, MoodleFile.from_local_data('validator.py', script, 'text/x-python'), "")
+    assert(first.load_validator().loaded != first.load_validator().loaded)
+
+
+def test_validator_template_copies():
+    assignment = _prepare_assignment()
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w') as validator_zip:
+        validator_zip.writestr('validator.py', 'def validate(job):\n    pass\n')
+        validator_zip.writestr('input.txt', 'reference data')
+        validator_zip.writestr('tests/case1.txt', 'case 1')
+    validator = MoodleFile.from_local_data('validator.zip', archive.getvalue(), 'application/zip')
+    submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1,
+                                  files=[MoodleFile.from_local_data('input.txt', b'student data', 'text/plain')])
+    job = Job(submission, validator, "")
+    template_dir = job._prepare_validator_dir()
+    job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+    try:
+        _copy_tree(template_dir, job.working_dir)
+        # Changes in the working directory never reach the shared template
+        with open(job.working_dir + 'tests/case1.txt', 'w') as copied_file:
+            copied_file.write('changed')
+        os.chmod(job.working_dir + 'tests/case1.txt', 0o755)
+        with open(os.path.join(template_dir, 'tests/case1.txt')) as template_file:
+            assert(template_file.read() == 'case 1')
+        assert(stat.S_IMODE(os.stat(os.path.join(template_dir, 'tests/case1.txt')).st_mode) != 0o755)
+        job.prepare_student_files()
+        assert(sorted(os.listdir(job.working_dir)) == ['input.txt', 'tests', 'validator.py'])
+        with open(job.working_dir + 'input.txt') as student_file:
+            assert(student_file.read() == 'student data')
+        with open(os.path.join(template_dir, 'input.txt')) as template_file:
+            assert(template_file.read() == 'reference data')
+    finally:
+        shutil.rmtree(job.working_dir)
+
+
+def test_result_store():
+    assignment = _prepare_assignment()
+    writer = _CollectingWriter()
+    with tempfile.TemporaryDirectory() as store_dir:
+        marker = store_dir + os.sep + 'runs'
+        script = 'def validate(job):\n    open({0!r}, "a").write("x")\n    job.send_fail_result("Wrong")\n'.format(marker)
+        store = ResultStore(store_dir + os.sep + 'results.sqlite', repost_identical=False)
+
+        def run(content):
+            submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1,
+                                          files=[MoodleFile.from_local_data('hello.c', content, 'text/x-csrc')])
+            validator = MoodleFile.from_local_data('validator.py', script.encode(), 'text/x-python')
+            job = Job(submission, validator, "", grade_writer=writer, result_store=store)
+            job.start()
+            return job
+
+        assert(run(b'int main() {}').outcome == ResultStore.FAIL)
+        writer.feedback.clear()
+        # Unchanged submission, validator is not executed, same feedback is not sent again
+        run(b'int main() {}')
+        assert(writer.feedback == {})
+        # Changed submission
+        run(b'int main() { return 0; }')
+        with open(marker) as runs:
+            assert(runs.read() == 'xx')
+        assert(store.hits == 1)
+        assert([run['cached'] for run in store.history()] == [0, 1, 0])
+        assert(store.history()[0]['usage'] == [])
+        assert(writer.feedback == {})
+
+
+class _FailingWriter():
+    def add_feedback(self, submission, feedback):
+        raise ConnectionError("Moodle is down")
+
+
+def test_result_store_errors():
+    assignment = _prepare_assignment()
+    submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1,
+                                  files=[MoodleFile.from_local_data('hello.c', b'int main() {}', 'text/x-csrc')])
+    writer = _CollectingWriter()
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = ResultStore(store_dir + os.sep + 'results.sqlite', repost_identical=False)
+        # Problem of the machine, not of the submission
+        broken = MoodleFile.from_local_data('validator.py', b'def validate(job):\n    job.prepare_student_files()\n'
+                                            b'    job.run_program("./missing_compiler")\n', 'text/x-python')
+        Job(submission, broken, "", grade_writer=writer, result_store=store).start()
+        assert(writer.feedback[1].startswith("Unexpected problem"))
+        assert(store.history() == [])
+        # Result is only stored after the delivery of the feedback
+        validator = MoodleFile.from_local_data('validator.py', b'def validate(job):\n    job.send_fail_result("Wrong")\n',
+                                               'text/x-python')
+        results = ValidationPool(workers=1).run([Job(submission, validator, "", grade_writer=_FailingWriter(),
+                                                     result_store=store)])
+        assert(results[0].error == "Moodle is down")
+        assert(store.history() == [])
+        ValidationPool(workers=1).run([Job(submission, validator, "", grade_writer=writer, result_store=store)])
+        assert(writer.feedback[1] == "Wrong")
+        assert([run['outcome'] for run in store.history()] == [ResultStore.FAIL])
+        # Lookups in the worker processes are counted in the parent process
+        ValidationPool(workers=1).run([Job(submission, validator, "", grade_writer=writer, result_store=store)])
+        assert(store.stats()['hits'] == 1 and store.stats()['misses'] == 3)
+
+
+def test_compiler_cache():
+    base_dir = os.path.dirname(__file__) + '/submfiles/validation/'
+    assignment = _prepare_assignment()
+    writer = _CollectingWriter()
+    script = b"""import os
+
+def validate(job):
+    job.prepare_student_files()
+    job.run_compiler(inputs=['helloworld.c'], output='helloworld')
+    assert(os.access(job.working_dir + 'helloworld', os.X_OK))
+"""
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = CompilerCache(cache_dir)
+        for i in range(2):
+            submission = MoodleSubmission.from_local_file(assignment=assignment, fpath=base_dir + '1000fff/helloworld.c')
+            validator = MoodleFile.from_local_data('validator.py', script, 'text/x-python')
+            Job(submission, validator, "", grade_writer=writer, compiler_cache=cache).start()
+            assert(writer.feedback[submission.userid] == "All tests passed. Awesome!")
+            del writer.feedback[submission.userid]
+        assert(cache.misses == 1 and cache.hits == 1)
+        assert(cache.stats()['entries'] == 1)
+
+
+def test_parallel_compilation():
+    assignment = _prepare_assignment()
+    validator = MoodleFile.from_local_data('validator.py', b'def validate(job):\n    pass\n', 'text/x-python')
+    sources = {'util.h': b'int twice(int x);\n',
+               'util.c': b'#include "util.h"\nint twice(int x) { return 2 * x; }\n',
+               'main.c': b'#include "util.h"\nint main() { return twice(21) == 42 ? 0 : 1; }\n'}
+
+    def build(files, cache):
+        submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1,
+                                      files=[MoodleFile.from_local_data(name, content, 'text/x-csrc')
+                                             for name, content in files.items()])
+        job = Job(submission, validator, "", compiler_cache=cache)
+        job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+        try:
+            job.prepare_student_files()
+            job.run_compiler(compiler=GCC, inputs=sorted(files), output='program', parallel=True)
+            assert(job.run_program('./program')[0] == 0)
+        finally:
+            shutil.rmtree(job.working_dir)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = CompilerCache(cache_dir)
+        build(sources, cache)
+        assert(cache.hits == 0)
+        # Resubmission with one changed file, object file for main.c is reused
+        sources['util.c'] = b'#include "util.h"\nint twice(int x) { return x + x; }\n'
+        build(sources, cache)
+        assert(cache.hits == 1)
+        sources['util.c'] = b'int twice(int x) { return x + }\n'
+        sources['main.c'] = b'int main() { return }\n'
+        try:
+            build(sources, cache)
+            assert(False)
+        except WrongExitStatusException as e:
+            assert('main.c:' in e.output and 'util.c:' in e.output)
+
+
+def test_benchmark_program():
+    assignment = _prepare_assignment()
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w') as validator_zip:
+        validator_zip.writestr('validator.py', 'def validate(job):\n    pass\n')
+        validator_zip.writestr('reference.sh', '#!/bin/sh\nexit 0\n')
+    validator = MoodleFile.from_local_data('validator.zip', archive.getvalue(), 'application/zip')
+    loop = b'int main() { volatile long sum = 0; for (long i = 0; i < %s; i++) sum += i; return 0; }\n'
+    sources = {'quadratic.c': loop % b'10000L * 10000L', 'linear.c': loop % b'10000L'}
+    submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1,
+                                  files=[MoodleFile.from_local_data(name, content, 'text/x-csrc')
+                                         for name, content in sources.items()])
+    job = Job(submission, validator, "")
+    job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+    try:
+        _copy_tree(job._prepare_validator_dir(), job.working_dir)
+        job.prepare_student_files()
+        job.run_compiler(compiler=GCC, inputs=['quadratic.c'], output='quadratic')
+        job.run_compiler(compiler=GCC, inputs=['linear.c'], output='linear')
+        result = job.benchmark_program('./quadratic', repeat=3, reference='./reference.sh', tolerance=2.0)
+        assert(len(result.runs) == 3 and len(result.reference.runs) == 3)
+        assert(result.min <= result.median <= result.p95)
+        assert(result.cpu_time > 0 and result.max_rss > 0)
+        assert(not result.acceptable)
+        assert(job.benchmark_program('./linear', repeat=3, warmup=0, reference='./reference.sh').acceptable)
+        # Setup runs are not part of the statistics, but of the job summary
+        assert(len(job.usage_summary()) == 2 + 2 * 4 + 2 * 3)
+    finally:
+        shutil.rmtree(job.working_dir)
+
+
+def test_reference_timeouts():
+    assignment = _prepare_assignment()
+    validator = MoodleFile.from_local_data('validator.py', b'def validate(job):\n    pass\n', 'text/x-python')
+    submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1, files=[])
+
+    def run(arguments):
+        job = Job(submission, validator, "")
+        job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+        job.prepared_student_files = True
+        # Reference solution ignores the arguments and ends immediately
+        job.use_reference_timeouts('true', factor=10, floor=0.5)
+        try:
+            started = time.monotonic()
+            try:
+                job.run_program('sleep', arguments)
+                assert(False)
+            except TimeoutException:
+                assert(time.monotonic() - started < 5)
+            # Explicit timeouts are still used
+            assert(job.run_program('sleep', ['0.6'], timeout=5)[0] == 0)
+            # Input of interactive programs is unknown, job timeout is used
+            prog = job.spawn_program('cat')
+            assert(prog._spawn.timeout == job.timeout)
+            prog.kill()
+            return [prog.name for prog in job.programs]
+        finally:
+            shutil.rmtree(job.working_dir)
+
+    assert(run(['10']) == ['true', 'sleep', 'sleep', 'cat'])
+    # Runtime of the reference is stored with the validator
+    assert(run(['10']) == ['sleep', 'sleep', 'cat'])
+    assert(run(['20']) == ['true', 'sleep', 'sleep', 'cat'])
+
+
+def test_reference_outputs():
+    assignment = _prepare_assignment()
+    validator = MoodleFile.from_local_data('validator.py', b'def validate(job):\n    pass\n', 'text/x-python')
+    submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1, files=[])
+
+    def run(program):
+        job = Job(submission, validator, "")
+        job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+        job.prepared_student_files = True
+        # Student solution just repeats the input
+        with open(job.working_dir + 'echo.sh', 'w') as script:
+            script.write('#!/bin/sh\ncat\n')
+        os.chmod(job.working_dir + 'echo.sh', 0o755)
+        try:
+            job.use_reference_solution('awk', inputs=[(['{ print $1 * 2 }'], '1\n2\n')])
+            results = [job.check_output(program, ['{ print $1 * 2 }'], '1\n2\n'),
+                       job.check_output(program, ['{ print $1 * 2 }'], '3\n', mode=compare.WHITESPACE)]
+            return results, [prog.name for prog in job.programs]
+        finally:
+            shutil.rmtree(job.working_dir)
+
+    results, programs = run('awk')
+    assert(all(results))
+    # Output of the student program is limited by the size of the reference output
+    job = Job(MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1, files=[]), validator, "")
+    job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+    job.prepared_student_files = True
+    job.OUTPUT_SLACK = 1000
+    for name, command in [('spaces.sh', 'cat; yes " " | head -c 100000000'), ('zeros.sh', 'head -c 100000000 /dev/zero')]:
+        with open(job.working_dir + name, 'w') as script:
+            script.write('#!/bin/sh\n' + command + '\n')
+        os.chmod(job.working_dir + name, 0o755)
+    try:
+        job.use_reference_solution('cat')
+        result = job.check_output('./spaces.sh', [], '1\n2\n', mode=compare.WHITESPACE)
+        assert(not result and result.actual == b'[too much output]')
+        result = job.check_output('./zeros.sh', [], '1\n2\n')
+        assert(not result and result.line == 1)
+        assert(job.programs[-1].output_file_truncated)
+    finally:
+        shutil.rmtree(job.working_dir)
+    assert(programs == ['awk', 'awk', 'awk', 'awk'])
+    # Reference outputs are reused, student output differs
+    results, programs = run('./echo.sh')
+    assert(programs == ['./echo.sh', './echo.sh'])
+    assert(not results[0] and results[0].line == 1)
+    assert((results[1].expected, results[1].actual) == (b'6', b'3'))
+
+
+def test_reference_from_validator():
+    archive = BytesIO()
+    with zipfile.ZipFile(archive, 'w') as validator_zip:
+        validator_zip.writestr('validator.py', 'def validate(job):\n    pass\n')
+        validator_zip.writestr('ref.sh', '#!/bin/sh\necho 42\n')
+    validator = MoodleFile.from_local_data('validator.zip', archive.getvalue(), 'application/zip')
+    assignment = _prepare_assignment()
+
+    def run(files):
+        submission = MoodleSubmission(conn=assignment.course.conn, assignment=assignment, user_id=1,
+                                      files=[MoodleFile.from_local_data(name, content, 'text/plain')
+                                             for name, content in files.items()])
+        job = Job(submission, validator, "")
+        job.working_dir = tempfile.mkdtemp(prefix='moodleteacher_') + os.sep
+        try:
+            _copy_tree(job._prepare_validator_dir(), job.working_dir)
+            job.prepare_student_files()
+            os.chmod(job.working_dir + 'solution.sh', 0o755)
+            job.use_reference_solution('./ref.sh')
+            return job.check_output('./solution.sh')
+        finally:
+            shutil.rmtree(job.working_dir)
+
+    # Submitted file with the name of the reference solution is not used as reference
+    cheating = run({'solution.sh': b'#!/bin/sh\necho 7\n', 'ref.sh': b'#!/bin/sh\necho 7\n'})
+    assert(not cheating and cheating.expected == b'42')
+    assert(run({'solution.sh': b'#!/bin/sh\necho 42\n'}))
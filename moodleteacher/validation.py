@@ -2,24 +2,105 @@
 Implementation of validation jobs.
 """
 
+import ast
+import fcntl
+import hashlib
 import os.path
 import os
 import sys
 import importlib
+import importlib.util
+import json
+import multiprocessing
+import multiprocessing.connection
 import re
 import shutil
+import signal
+import stat
 import tempfile
+import time
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from .exceptions import *
-from .compiler import GCC, compiler_cmdline
-from .runnable import RunningProgram
+from .compiler import GCC, GPP, HEADER_EXTENSIONS, compiler_cmdline, object_cmdline
+from .results import ResultStore
+from .benchmark import BenchmarkResult
+from . import compare
+from . import runnable
+from .runnable import RunningProgram, PipedProgram
 
 logger = logging.getLogger('moodleteacher')
 
 
 VALIDATOR_IMPORT_NAME = 'validator'
 
+# Validator files are stored here once per content hash
+VALIDATOR_CACHE_DIR = os.path.expanduser("~/.cache/moodleteacher/validators")
+
+# Loaded validator modules, by content hash of the validator file
+_validator_modules = {}
+
+
+# ioctl request for copy-on-write clones of a file on Linux (btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def _clone_file(source_file, target_file):
+    """
+    Copy a file as copy-on-write clone if the file system supports it,
+    or as normal copy otherwise. The copy never shares its content
+    with the source, so jobs can change it freely.
+
+    Only copy-on-write file systems, such as btrfs or XFS, support clones.
+    On others, such as ext4, each job therefore pays for a full copy of the
+    validator files.
+    """
+    with open(source_file, 'rb') as source, open(target_file, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            shutil.copyfileobj(source, target)
+    os.chmod(target_file, stat.S_IMODE(os.stat(source_file).st_mode) | stat.S_IWUSR)
+
+
+def _copy_tree(source_dir, target_dir):
+    """
+    Fill target_dir with copies of all files in source_dir.
+    """
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        target = os.path.normpath(os.path.join(target_dir, os.path.relpath(dirpath, source_dir)))
+        os.makedirs(target, exist_ok=True)
+        for filename in filenames:
+            _clone_file(os.path.join(dirpath, filename), os.path.join(target, filename))
+
+
+def _move_tree(source_dir, target_dir):
+    """
+    Move all files from source_dir to target_dir on the same file system,
+    replacing existing files.
+    """
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        target = os.path.normpath(os.path.join(target_dir, os.path.relpath(dirpath, source_dir)))
+        os.makedirs(target, exist_ok=True)
+        for filename in filenames:
+            os.replace(os.path.join(dirpath, filename), os.path.join(target, filename))
+
+
+def _reloads_per_job(script_name):
+    """
+    Check if a validator script sets RELOAD_PER_JOB, without executing it.
+    """
+    with open(script_name, 'rb') as script:
+        tree = ast.parse(script.read(), script_name)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(target, ast.Name) and target.id == 'RELOAD_PER_JOB'
+                                                for target in node.targets):
+            return not (isinstance(node.value, ast.Constant) and not node.value.value)
+    return False
+
 
 class Job():
     """
@@ -31,8 +112,15 @@ class Job():
     working_dir = None                   # The temporary working directory with all the content
     get_files_called = False
     prepared_student_files = False
-
-    def __init__(self, submission, validator_file, preamble):
+    outcome = None                       # ResultStore.PASS or ResultStore.FAIL, after the result was sent
+    feedback = None                      # The last feedback text sent to Moodle
+    timeout = 30                         # Default timeout for all programs, in seconds
+    reference_program = None             # Reference solution for timeouts and expected outputs
+    timeout_factor = None                # Timeouts are derived from the reference solution, if set
+    OUTPUT_SLACK = 64 * 1024             # Additional output bytes accepted by check_output()
+
+    def __init__(self, submission, validator_file, preamble, grade_writer=None, result_store=None, compiler_cache=None,
+                 limits=None):
         """
         Prepares a validation job by putting all relevant files into a temporary
         directory.
@@ -41,10 +129,25 @@ class Job():
             submission (MoodleSubmission):            The student submission object.
             validator_file (MoodleFile):              The validator file object.
             preamble (str):                           The preamble text for each feedback message targeting students.
+            grade_writer (MoodleGradeWriter):         Optional writer that collects the feedback for a batched upload,
+                                                      instead of sending it directly.
+            result_store (ResultStore):               Optional store with earlier validation results. If the
+                                                      submission and the validator did not change since then,
+                                                      the stored result is used instead of running the validator.
+            compiler_cache (CompilerCache):           Optional cache for the results of :meth:`run_compiler`.
+            limits (ResourceLimits):                  Default resource limits for student programs started with
+                                                      :meth:`run_program` and :meth:`spawn_program`.
         """
         self.submission = submission
         self.validator_file = validator_file
         self.preamble = preamble
+        self.grade_writer = grade_writer
+        self.result_store = result_store
+        self.compiler_cache = compiler_cache
+        self.limits = limits
+        self._validator_hash = None
+        self._programs = []
+        self.programs = []                   # All programs started by this job
 
     def __str__(self):
         return str(vars(self))
@@ -55,11 +158,106 @@ class Job():
     def validator_script_name(self):
         return self.working_dir + VALIDATOR_IMPORT_NAME + '.py'
 
+    @property
+    def validator_hash(self):
+        """
+        The content hash of the validator file, identifying the validator in all caches.
+        """
+        if self._validator_hash is None:
+            self._validator_hash = self.validator_file.content_hash()
+        return self._validator_hash
+
+    @property
+    def result_key(self):
+        """
+        A hash of the validator and of all submission files, identifying the result of this job.
+        """
+        sha = hashlib.sha256(self.validator_hash.encode())
+        for f in sorted(self.submission.files, key=lambda f: f.relative_path + f.name):
+            sha.update((f.relative_path + f.name).encode('utf-8'))
+            sha.update(f.content_hash().encode())
+        if self.submission.textfield:
+            sha.update(self.submission.textfield.encode('utf-8'))
+        return sha.hexdigest()
+
+    def _prepare_validator_dir(self):
+        """
+        Unpack the validator file once into a template directory
+        that is shared by all jobs with the same validator.
+
+        Returns:
+            str: The template directory.
+        """
+        validator_dir = os.path.join(VALIDATOR_CACHE_DIR, self.validator_hash)
+        template_dir = os.path.join(validator_dir, 'files')
+        if os.path.isdir(template_dir):
+            return template_dir
+        os.makedirs(validator_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='tmp_', dir=validator_dir)
+        logger.debug("Preparing validator template in {0}.".format(template_dir))
+        if self.validator_file.is_archive:
+            self.validator_file.unpack_to(tmp_dir + os.sep, remove_directories=False)
+        else:
+            self.validator_file.save_as(tmp_dir + os.sep, VALIDATOR_IMPORT_NAME + '.py')
+        try:
+            os.rename(tmp_dir, template_dir)
+        except OSError:
+            # Prepared in parallel by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return template_dir
+
+    def load_validator(self):
+        """
+        Load the validator script as Python module.
+
+        The module is only loaded once for each validator content, under a unique
+        module name, and shared by all jobs. Validators with module-level state
+        that must not survive between jobs can set `RELOAD_PER_JOB = True`, in order
+        to be loaded again for every job.
+
+        Returns:
+            module: The loaded validator module.
+        """
+        digest = self.validator_hash
+        module = _validator_modules.get(digest)
+        if module and not getattr(module, 'RELOAD_PER_JOB', False):
+            logger.debug("Using already loaded validator {0}.".format(module.__name__))
+            return module
+        validator_dir = self._prepare_validator_dir()
+        script_name = os.path.join(validator_dir, VALIDATOR_IMPORT_NAME + '.py')
+        if not os.path.exists(script_name):
+            raise FileNotFoundError("Missing validator file at {0}.".format(script_name))
+        module_name = VALIDATOR_IMPORT_NAME + '_' + digest[:16]
+        logger.debug("Loading validator {0} from {1}.".format(module_name, script_name))
+        spec = importlib.util.spec_from_file_location(module_name, script_name)
+        module = importlib.util.module_from_spec(spec)
+        old_path = sys.path
+        sys.path = [validator_dir] + old_path
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            sys.path = old_path
+        sys.modules[module_name] = module
+        _validator_modules[digest] = module
+        return module
+
     def start(self, log_level=logging.INFO):
         """
         Execute the validate() method in the validator script belonging to this job.
         """
         logger.setLevel(log_level)
+        started = time.monotonic()
+
+        if self.result_store:
+            key = self.result_key
+            stored = self.result_store.lookup(key)
+            if stored:
+                logger.info("Submission and validator did not change, using the stored result.")
+                self.outcome = stored['outcome']
+                self._publish(stored['feedback'])
+                self.result_store.record(key, self.validator_hash, self.submission, self.outcome,
+                                         self.feedback, time.monotonic() - started, cached=True)
+                return
 
         # Create temporary directory for validation
         self.working_dir = tempfile.mkdtemp(prefix='moodleteacher_')
@@ -67,16 +265,10 @@ class Job():
             self.working_dir += os.sep
         logger.debug("Created fresh working directory at {0}.".format(self.working_dir))
 
-        # Store validator file in temporary directory
-        if self.validator_file.is_archive:
-            # We assume that a validator file with the correct name
-            # exists inside the archive
-            logger.debug("Validator is an archive, assuming {0}.py to be inside.".format(VALIDATOR_IMPORT_NAME))
-            self.validator_file.unpack_to(self.working_dir, remove_directories=False)
-        else:
-            # The file is the validator, so we can rename it to match
-            logger.debug("Moving validator content to {0}.".format(self.validator_script_name))
-            self.validator_file.save_as(self.working_dir, VALIDATOR_IMPORT_NAME + '.py')
+        # Fill temporary directory with the validator files
+        template_dir = self._prepare_validator_dir()
+        logger.debug("Copying validator files from {0}.".format(template_dir))
+        _copy_tree(template_dir, self.working_dir)
 
         # Load validator to be called
         if not os.path.exists(self.validator_script_name):
@@ -86,15 +278,12 @@ class Job():
         sys.path = [self.working_dir] + old_path
 
         try:
-            logger.debug("Loading validator.")
-            module = importlib.import_module(VALIDATOR_IMPORT_NAME)
+            module = self.load_validator()
         except Exception as e:
             logger.error("Exception while loading the validator: " + str(e))
+            sys.path = old_path
             return
 
-        # Demanded by looped validator loading in the test suite
-        importlib.reload(module)
-
         # make the call
         try:
             module.validate(self)
@@ -136,28 +325,86 @@ class Job():
                 raise(e)
             # We got the text. Report the problem.
             logger.info("A problem occured, message sent to the student: '{0}'".format(text_student))
+            self.outcome = ResultStore.FAIL
             self._send_result(text_student)
+            if type(e) in (TerminationException, WrongExitStatusException):
+                # Caused by the student program. Other problems, such as timeouts
+                # under load or a missing compiler, may be gone in the next run.
+                self._store_result(started)
             # roll back
             sys.path = old_path
             # keep temporary directory for debugging
             return
+        finally:
+            self._kill_programs()
         # no unhandled exception during the execution of the validator
         if not self.result_sent:
             logger.debug(
                 "Validation script forgot result sending, assuming success.")
             self.send_pass_result()
+        self._store_result(started)
         # roll back
         sys.path = old_path
         # Test script was executed, result was somehow sent
         # Clean the file system, since we can't do anything else
         shutil.rmtree(self.working_dir, ignore_errors=True)
 
+    def _piped_program(self, name, arguments, timeout, encoding=None, stdin=None, limits=None, output_file=None,
+                       working_dir=None, output_file_limit=None):
+        prog = PipedProgram(name, arguments, working_dir if working_dir else self.working_dir, timeout, encoding,
+                            stdin, limits=limits, output_file=output_file, output_file_limit=output_file_limit)
+        self.programs.append(prog)
+        return prog
+
+    def usage_summary(self):
+        """
+        Get the resources used by the programs that this job started.
+
+        Returns:
+            list: A dictionary for each finished program, with its name, arguments,
+            wall time, user and system CPU time in seconds, and peak memory in bytes.
+        """
+        return [dict(program=prog.name, arguments=list(prog.arguments), **prog.usage.as_dict())
+                for prog in self.programs if prog.usage]
+
+    def _kill_programs(self):
+        """
+        Make sure that no program started by the validator keeps running.
+        """
+        for prog in self._programs:
+            prog.kill()
+        self._programs = []
+        for prog in self.programs:
+            if prog.usage:
+                logger.info("Resources used by '{0}': {1}".format(prog.name, prog.usage))
+
     def _send_result(self, info_student):
         # TODO: Send as Moodle comment
-        logger.info('Sending result to Moodle ...')
-        self.submission.save_feedback(self.preamble + info_student)
+        self._publish(self.preamble + info_student)
+
+    def _publish(self, feedback):
+        if self.result_store and not self.result_store.repost_identical and \
+                self.result_store.last_feedback(self.submission) == feedback:
+            logger.info("The same feedback was sent before, not sending it again.")
+        else:
+            self._deliver_feedback(feedback)
+        self.feedback = feedback
         self.result_sent = True
 
+    def _store_result(self, started):
+        if self.result_store and self.result_sent:
+            self.result_store.record(self.result_key, self.validator_hash, self.submission,
+                                     self.outcome, self.feedback, time.monotonic() - started,
+                                     usage=self.usage_summary())
+
+    def _deliver_feedback(self, feedback):
+        if self.grade_writer:
+            logger.info('Queueing result for Moodle ...')
+            self.grade_writer.add_feedback(self.submission, feedback)
+        else:
+            logger.info('Sending result to Moodle ...')
+            self.submission.save_feedback(feedback)
+
     def prepare_student_files(self, remove_directories=True, recode=False):
         """Unarchive student files in temporary directory.
 
@@ -173,12 +420,18 @@ class Job():
             raise NoFilesException()
 
         assert(self.working_dir)
+        # Unpack in a separate directory first, so that the working directory only
+        # gets the files of a complete unpack, which replace validator files of the same name
+        staging_dir = tempfile.mkdtemp(prefix='.student_', dir=self.working_dir)
         try:
             for f in self.submission.files:
-                f.unpack_to(self.working_dir, remove_directories, recode)
+                f.unpack_to(staging_dir + os.sep, remove_directories, recode)
+            _move_tree(staging_dir, self.working_dir)
         except Exception as e:
             logger.error("Error while unpacking student files: {}".format(e))
             raise NoFilesException()
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
         self.prepared_student_files = True
 
     def send_fail_result(self, info_student, info_tutor="Test failed."):
@@ -191,6 +444,7 @@ class Job():
         """
         logger.info("Fail result sent for the tutor: '{0}'".format(info_tutor))
         logger.info("Fail result sent for the student: '{0}'".format(info_student))
+        self.outcome = ResultStore.FAIL
         self._send_result(info_student)
 
     def send_pass_result(self,
@@ -205,14 +459,16 @@ class Job():
         """
         logger.info("Pass result sent for the tutor: '{0}'".format(info_tutor))
         logger.info("Pass result sent for the student: '{0}'".format(info_student))
+        self.outcome = ResultStore.PASS
         self._send_result(info_student)
 
-    def run_configure(self, mandatory=True, timeout=30):
+    def run_configure(self, mandatory=True, timeout=None):
         """Runs the 'configure' program in the working directory.
 
         Args:
             mandatory (bool): Throw exception if 'configure' fails or a
                               'configure' file is missing.
+            timeout (int):    The timeout for execution, by default the job timeout.
 
         """
         if not self.prepared_student_files:
@@ -225,18 +481,19 @@ class Job():
             else:
                 return
         try:
-            prog = RunningProgram('configure', [], self.working_dir, timeout)
+            prog = self._piped_program('./configure', [], timeout if timeout else self.timeout)
             prog.expect_exitstatus(0)
         except Exception:
             if mandatory:
                 raise
 
-    def run_make(self, mandatory=True, timeout=30):
+    def run_make(self, mandatory=True, timeout=None):
         """Runs the 'make' program in the working directory.
 
         Args:
             mandatory (bool): Throw exception if 'make' fails or a
                               'Makefile' file is missing.
+            timeout (int):    The timeout for execution, by default the job timeout.
 
         """
         if not self.prepared_student_files:
@@ -248,13 +505,13 @@ class Job():
             else:
                 return
         try:
-            prog = RunningProgram('make', [], self.working_dir, timeout)
+            prog = self._piped_program('make', [], timeout if timeout else self.timeout)
             prog.expect_exitstatus(0)
         except Exception:
             if mandatory:
                 raise
 
-    def run_compiler(self, compiler=GCC, inputs=None, output=None, timeout=30):
+    def run_compiler(self, compiler=GCC, inputs=None, output=None, timeout=None, parallel=False):
         """Runs a compiler in the working directory.
 
         Args:
@@ -262,20 +519,81 @@ class Job():
                               including placeholders for output and input files.
             inputs (tuple):   The list of input files for the compiler.
             output (str):     The name of the output file.
+            timeout (int):    The timeout for each compiler run, by default the job timeout.
+            parallel (bool):  Compile each translation unit separately in parallel,
+                              and link the object files afterwards. Only supported for
+                              GCC and GPP, ignored for other compilers.
 
         """
         if not self.prepared_student_files:
             raise ValidatorBrokenException("prepare_student_files() was not called before.")
 
+        if not timeout:
+            timeout = self.timeout
         # Let exceptions travel through
         compiler_cmd, compiler_args = compiler_cmdline(compiler=compiler,
                                                        inputs=inputs,
                                                        output=output)
 
-        prog = RunningProgram(compiler_cmd, compiler_args, self.working_dir, timeout)
+        if self.compiler_cache:
+            key = self.compiler_cache.key(compiler, [compiler_cmd] + compiler_args, self.working_dir)
+            if self.compiler_cache.restore(key, self.working_dir):
+                logger.debug("Using cached compiler output.")
+                return
+            before = self.compiler_cache.snapshot(self.working_dir)
+
+        if parallel and compiler in [GCC, GPP]:
+            self._run_parallel_compiler(compiler, inputs, output, timeout)
+        else:
+            prog = self._piped_program(compiler_cmd, compiler_args, timeout)
+            prog.expect_exitstatus(0)
+
+        if self.compiler_cache:
+            self.compiler_cache.store(key, self.working_dir, before)
+
+    def _compile_unit(self, compiler, source, timeout):
+        """
+        Compile a single translation unit into an object file.
+
+        Returns:
+            WrongExitStatusException: The compiler error, or None.
+        """
+        obj = source + '.o'
+        compiler_cmd, compiler_args = object_cmdline(compiler, source, obj)
+        if self.compiler_cache:
+            key = self.compiler_cache.object_key([compiler_cmd] + compiler_args, self.working_dir, source)
+            if self.compiler_cache.restore(key, self.working_dir):
+                logger.debug("Using cached object file for {0}.".format(source))
+                return None
+        prog = self._piped_program(compiler_cmd, compiler_args, timeout)
+        try:
+            prog.expect_exitstatus(0)
+        except WrongExitStatusException as e:
+            return e
+        if self.compiler_cache:
+            self.compiler_cache.store_files(key, self.working_dir, [obj])
+        return None
+
+    def _run_parallel_compiler(self, compiler, inputs, output, timeout):
+        sources = [fname for fname in inputs if not fname.endswith(HEADER_EXTENSIONS)]
+        logger.debug("Compiling {0} translation units in parallel.".format(len(sources)))
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            errors = list(executor.map(lambda source: self._compile_unit(compiler, source, timeout), sources))
+        failed = [(source, error) for source, error in zip(sources, errors) if error]
+        if failed:
+            # Report the compiler output for each broken file
+            output_text = "\n".join("{0}:\n{1}".format(source, error.output) for source, error in failed)
+            raise WrongExitStatusException(instance=failed[0][1].instance,
+                                           expected=0,
+                                           got=failed[0][1].got,
+                                           output=output_text)
+        compiler_cmd, compiler_args = compiler_cmdline(compiler=compiler,
+                                                       inputs=[source + '.o' for source in sources],
+                                                       output=output)
+        prog = self._piped_program(compiler_cmd, compiler_args, timeout)
         prog.expect_exitstatus(0)
 
-    def run_build(self, compiler=GCC, inputs=None, output=None, timeout=30):
+    def run_build(self, compiler=GCC, inputs=None, output=None, timeout=None, parallel=False):
         """Combined call of 'configure', 'make' and the compiler.
 
         The success of 'configure' and 'make' is optional.
@@ -288,9 +606,9 @@ class Job():
         logger.info("Running build steps ...")
         self.run_configure(mandatory=False, timeout=timeout)
         self.run_make(mandatory=False, timeout=timeout)
-        self.run_compiler(compiler, inputs, output, timeout=timeout)
+        self.run_compiler(compiler, inputs, output, timeout=timeout, parallel=parallel)
 
-    def spawn_program(self, name, arguments=[], timeout=30, encoding=None):
+    def spawn_program(self, name, arguments=[], timeout=None, encoding=None, limits=None):
         """Spawns a program in the working directory.
 
         This method allows the interaction with the running program,
@@ -299,10 +617,11 @@ class Job():
         Args:
             name (str):        The name of the program to be executed.
             arguments (tuple): Command-line arguments for the program.
-            timeout (int):     The timeout for execution.
+            timeout (int):     The timeout for execution, by default the job timeout.
             encoding (str):    The text encoding for the program output,
                                e.g. 'utf-8'. If this parameter is not set,
                                then the output is interpreted as bytes.
+            limits (ResourceLimits): Resource limits for the program, instead of the job limits.
 
         Returns:
             RunningProgram: An object representing the running program.
@@ -312,18 +631,34 @@ class Job():
             raise ValidatorBrokenException("prepare_student_files() was not called before.")
 
         logger.debug("Spawning program for interaction ...")
-        return RunningProgram(name, arguments, self.working_dir, timeout, encoding)
-
-    def run_program(self, name, arguments=[], timeout=30, encoding=None):
+        if timeout is None:
+            # The input of interactive programs is not known in advance,
+            # so reference timeouts do not apply
+            timeout = self.timeout
+        prog = RunningProgram(name, arguments, self.working_dir, timeout, encoding,
+                              limits=limits if limits else self.limits)
+        # Killed at the end of the job, if the validator did not wait for the end
+        self._programs.append(prog)
+        self.programs.append(prog)
+        return prog
+
+    def run_program(self, name, arguments=[], timeout=None, encoding=None, stdin=None, limits=None):
         """Runs a program in the working directory to completion.
 
+        The program runs without a terminal. Use :meth:`spawn_program` for
+        programs that need interaction or a terminal.
+
         Args:
             name (str):        The name of the program to be executed.
             arguments (tuple): Command-line arguments for the program.
-            timeout (int):     The timeout for execution.
+            timeout (int):     The timeout for execution. By default, the timeout is derived
+                               from the reference solution, see :meth:`use_reference_timeouts`,
+                               or the job timeout is used.
             encoding (str):    The text encoding for the program output,
                                e.g. 'utf-8'. If this parameter is not set,
                                then the output is interpreted as bytes.
+            stdin:             Input for the program, as bytes, text or open file.
+            limits (ResourceLimits): Resource limits for the program, instead of the job limits.
 
         Returns:
             tuple: A tuple of the exit code, as reported by the operating system,
@@ -334,9 +669,264 @@ class Job():
 
         logger.debug("Running program ...")
 
-        prog = RunningProgram(name, arguments, self.working_dir, timeout, encoding)
+        if timeout is None:
+            if hasattr(stdin, 'read'):
+                # Needed for the reference runtime lookup
+                stdin = stdin.read()
+            timeout = self._program_timeout(arguments, stdin)
+        prog = self._piped_program(name, arguments, timeout, encoding, stdin,
+                                   limits=limits if limits else self.limits)
         return prog.expect_end()
 
+    def benchmark_program(self, name, arguments=[], stdin=None, repeat=5, warmup=1, timeout=None,
+                          reference=None, tolerance=2.0, limits=None):
+        """Runs a program several times and measures its resource usage.
+
+        All runs must end with exit status 0. The first `warmup` runs fill
+        the file system caches and are not measured.
+
+        Args:
+            name (str):        The name of the program to be executed.
+            arguments (tuple): Command-line arguments for the program.
+            stdin:             Input for the program, as bytes, text or open file.
+            repeat (int):      The number of measured runs.
+            warmup (int):      The number of runs before the measurement.
+            timeout (int):     The timeout for each run, see :meth:`run_program`.
+            reference (str):   A reference program from the validator archive, or an installed program,
+                               that is benchmarked with the same arguments and input. It runs in
+                               a separate directory with a copy of the validator files.
+            tolerance (float): Allowed slowdown factor against the reference program.
+            limits (ResourceLimits): Resource limits for the program, instead of the job limits.
+
+        Returns:
+            BenchmarkResult: The timing statistics. Check :attr:`BenchmarkResult.acceptable`
+            for the comparison with the reference program.
+        """
+        if not self.prepared_student_files:
+            raise ValidatorBrokenException("prepare_student_files() was not called before.")
+        if hasattr(stdin, 'read'):
+            # Same input for every run
+            stdin = stdin.read()
+        if timeout is None:
+            timeout = self._program_timeout(arguments, stdin)
+
+        def measure(program, working_dir=None):
+            runs = []
+            for run in range(warmup + repeat):
+                prog = self._piped_program(program, arguments, timeout, stdin=stdin,
+                                           limits=limits if limits else self.limits, working_dir=working_dir)
+                prog.expect_exitstatus(0)
+                if run >= warmup:
+                    runs.append(prog.usage)
+            return BenchmarkResult(program, runs)
+
+        logger.debug("Benchmarking '{0}' with {1} runs".format(name, repeat))
+        result = measure(name)
+        if reference:
+            with self._validator_copy(reference) as reference_dir:
+                result.reference = measure(reference, reference_dir)
+            result.tolerance = tolerance
+        logger.info(str(result))
+        return result
+
+    def use_reference_timeouts(self, name, factor=10, floor=1, ceiling=None):
+        """Derive the timeouts of student programs from the runtime of a reference solution.
+
+        For each combination of command-line arguments and input used with
+        :meth:`run_program`, :meth:`benchmark_program` or :meth:`check_output`,
+        the reference solution is run once, as described in :meth:`use_reference_solution`. Its runtime is stored next to the
+        validator, so that all later jobs with the same validator reuse it.
+        Explicit timeouts given to these methods are still respected.
+
+        Args:
+            name (str):        The reference program, see :meth:`use_reference_solution`.
+            factor (float):    The timeout is this multiple of the reference runtime.
+            floor (float):     The minimal timeout in seconds.
+            ceiling (float):   The maximal timeout in seconds, by default the job timeout.
+        """
+        self.reference_program = name
+        self.timeout_factor = factor
+        self.min_timeout = floor
+        self.max_timeout = ceiling if ceiling else self.timeout
+
+    def use_reference_solution(self, name, inputs=[]):
+        """Register a reference solution for :meth:`reference_output` and :meth:`check_output`.
+
+        The outputs of the reference solution are stored next to the validator,
+        so that the reference solution runs only once per input for all jobs
+        with the same validator. The reference solution does not run in the
+        working directory, which also contains the student files, but in a
+        separate directory with a copy of the validator files.
+
+        Args:
+            name (str):        The reference program, either from the validator archive,
+                               such as './reference', or an installed program.
+            inputs (list):     Tuples of command-line arguments and standard input,
+                               for which the reference outputs are computed right away.
+        """
+        self.reference_program = name
+        for arguments, stdin in inputs:
+            self.reference_output(arguments, stdin)
+
+    @property
+    def _reference_dir(self):
+        return os.path.join(VALIDATOR_CACHE_DIR, self.validator_hash)
+
+    @property
+    def _runtimes_path(self):
+        return os.path.join(self._reference_dir, 'runtimes.json')
+
+    def _load_runtimes(self):
+        try:
+            with open(self._runtimes_path) as runtimes:
+                return json.load(runtimes)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _reference_key(self, arguments, stdin):
+        if not self.reference_program:
+            raise ValidatorBrokenException("No reference solution was registered before.")
+        sha = hashlib.sha256(json.dumps([self.reference_program, list(arguments)]).encode('utf-8'))
+        if stdin:
+            sha.update(stdin)
+        return sha.hexdigest()
+
+    @contextmanager
+    def _validator_copy(self, program):
+        """
+        A scratch directory with a copy of the validator files, for running a reference program.
+        Student files may replace validator files in the working directory, so it is not used.
+        """
+        directory = tempfile.mkdtemp(prefix='moodleteacher_reference_') + os.sep
+        try:
+            _copy_tree(self._prepare_validator_dir(), directory)
+            if program.startswith('./'):
+                # Archives do not always keep the executable flag
+                program_path = directory + program[2:]
+                if os.path.isfile(program_path):
+                    os.chmod(program_path, os.stat(program_path).st_mode | stat.S_IXUSR)
+            yield directory
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _run_reference(self, key, arguments, stdin):
+        """
+        Run the reference solution, and store its runtime and output.
+        """
+        logger.debug("Running reference solution '{0}'.".format(self.reference_program))
+        output_dir = os.path.join(self._reference_dir, 'outputs')
+        os.makedirs(output_dir, exist_ok=True)
+        timeout = self.max_timeout if self.timeout_factor else self.timeout
+        with self._validator_copy(self.reference_program) as reference_dir:
+            with tempfile.NamedTemporaryFile(dir=output_dir, delete=False) as output:
+                prog = self._piped_program(self.reference_program, arguments, timeout, stdin=stdin,
+                                           output_file=output, working_dir=reference_dir)
+                try:
+                    prog.expect_exitstatus(0)
+                except (TimeoutException, WrongExitStatusException):
+                    os.remove(output.name)
+                    raise ValidatorBrokenException(
+                        info_tutor="Reference solution '{0}' failed with input {1}.".format(self.reference_program,
+                                                                                           arguments))
+        os.replace(output.name, os.path.join(output_dir, key))
+        # Other jobs with the same validator may store their runtimes in parallel
+        runtimes = self._load_runtimes()
+        runtimes[key] = prog.usage.wall_time
+        with tempfile.NamedTemporaryFile('w', dir=self._reference_dir, delete=False) as tmp:
+            json.dump(runtimes, tmp)
+        os.replace(tmp.name, self._runtimes_path)
+        return prog.usage.wall_time
+
+    def reference_runtime(self, arguments=[], stdin=None):
+        """Get the runtime of the reference solution for some arguments and input.
+
+        The reference solution is only run when no runtime is stored
+        for this validator so far.
+
+        Returns:
+            float: The wall clock time of the reference run in seconds.
+        """
+        if isinstance(stdin, str):
+            stdin = stdin.encode('utf-8')
+        key = self._reference_key(arguments, stdin)
+        runtime = self._load_runtimes().get(key)
+        if runtime is None:
+            runtime = self._run_reference(key, arguments, stdin)
+        return runtime
+
+    def reference_output(self, arguments=[], stdin=None):
+        """Get the output of the reference solution for some arguments and input.
+
+        The reference solution is only run when no output is stored
+        for this validator so far.
+
+        Returns:
+            str: The path of the file with the reference output.
+        """
+        if isinstance(stdin, str):
+            stdin = stdin.encode('utf-8')
+        key = self._reference_key(arguments, stdin)
+        path = os.path.join(self._reference_dir, 'outputs', key)
+        if not os.path.exists(path):
+            self._run_reference(key, arguments, stdin)
+        return path
+
+    def check_output(self, name, arguments=[], stdin=None, mode=compare.EXACT, tolerance=1e-6, timeout=None,
+                     limits=None):
+        """Runs a program and compares its output with the output of the reference solution.
+
+        Both outputs are compared chunk by chunk from files, so that large
+        outputs are not kept in memory. The output of the program is only stored
+        up to twice the size of the reference output plus OUTPUT_SLACK bytes;
+        more output counts as a difference. The exit status of the program is not
+        checked.
+
+        Args:
+            name (str):        The name of the program to be executed.
+            arguments (tuple): Command-line arguments for the program.
+            stdin:             Input for the program, as bytes, text or open file.
+            mode (str):        The comparison mode from :mod:`moodleteacher.compare`,
+                               EXACT, WHITESPACE or NUMERIC.
+            tolerance (float): Allowed difference of numbers in NUMERIC mode.
+            timeout (int):     The timeout for execution, see :meth:`run_program`.
+            limits (ResourceLimits): Resource limits for the program, instead of the job limits.
+
+        Returns:
+            ComparisonResult: The first difference, or a true value if the outputs match.
+        """
+        if not self.prepared_student_files:
+            raise ValidatorBrokenException("prepare_student_files() was not called before.")
+        if hasattr(stdin, 'read'):
+            stdin = stdin.read()
+        if isinstance(stdin, str):
+            stdin = stdin.encode('utf-8')
+        expected_path = self.reference_output(arguments, stdin)
+        if timeout is None:
+            timeout = self._program_timeout(arguments, stdin)
+        with tempfile.TemporaryFile() as output:
+            prog = self._piped_program(name, arguments, timeout, stdin=stdin,
+                                       limits=limits if limits else self.limits, output_file=output,
+                                       output_file_limit=2 * os.path.getsize(expected_path) + self.OUTPUT_SLACK)
+            prog.expect_end()
+            output.seek(0)
+            with open(expected_path, 'rb') as expected:
+                result = compare.compare(expected, output, mode, tolerance)
+                if result and prog.output_file_truncated:
+                    # Equal up to the limit, e.g. with lots of whitespace in WHITESPACE mode
+                    expected.seek(0)
+                    lines = sum(chunk.count(b'\n') for chunk in iter(lambda: expected.read(compare.CHUNK_SIZE), b''))
+                    result = compare.ComparisonResult(lines + 1, None, b'[too much output]')
+        logger.debug("Output of '{0}' compared with the reference solution: {1}".format(name, result))
+        return result
+
+    def _program_timeout(self, arguments, stdin=None):
+        if not self.timeout_factor:
+            return self.timeout
+        timeout = self.reference_runtime(arguments, stdin) * self.timeout_factor
+        timeout = min(max(timeout, self.min_timeout), self.max_timeout)
+        logger.debug("Using timeout of {0:.2f} seconds, derived from the reference solution.".format(timeout))
+        return timeout
+
     def grep(self, regex):
         """Scans the student files for text patterns.
 
@@ -379,3 +969,266 @@ class Job():
             if fname not in dircontent:
                 return False
         return True
+
+
+class ValidationResult():
+    """
+    The outcome of a validation job that was executed by a :class:`ValidationPool`.
+
+    Attributes:
+        job (Job):          The validation job.
+        status (str):       FINISHED, TIMEOUT or CRASHED.
+        feedback (list):    The feedback texts sent by the validator.
+        usage (list):       The resources used by the programs of the job, see :meth:`Job.usage_summary`.
+        exitcode (int):     Exit code of the worker process, or None.
+        duration (float):   Wall clock time for the job in seconds.
+        error (str):        Problem description for jobs that did not finish.
+    """
+    FINISHED = 'finished'
+    TIMEOUT = 'timeout'
+    CRASHED = 'crashed'
+
+    def __init__(self, job):
+        self.job = job
+        self.status = None
+        self.feedback = []
+        self.usage = []
+        self.exitcode = None
+        self.duration = None
+        self.error = None
+
+    def __str__(self):
+        return "Validation of {0}: {1} after {2:.1f}s".format(self.job.submission, self.status, self.duration or 0)
+
+    @property
+    def success(self):
+        return self.status == self.FINISHED
+
+
+class _ChannelWriter():
+    """
+    Stands in for the grade writer of a job inside a worker process,
+    and hands all feedback over to the parent process.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def add_feedback(self, submission, feedback):
+        self.channel.send(('feedback', feedback))
+
+
+class _ChannelStore():
+    """
+    Stands in for the result store of a job inside a worker process.
+    Results are recorded by the parent process, after the feedback was delivered.
+    """
+
+    def __init__(self, store, channel):
+        self.store = store
+        self.channel = channel
+        self.repost_identical = store.repost_identical
+
+    def lookup(self, key):
+        stored = self.store.lookup(key)
+        # Counted in the parent process, the counts of this process are lost
+        self.channel.send(('lookup', stored is not None))
+        return stored
+
+    def last_feedback(self, submission):
+        return self.store.last_feedback(submission)
+
+    def record(self, key, validator, submission, outcome, feedback, duration, cached=False, usage=None):
+        self.channel.send(('record', (key, validator, outcome, feedback, duration, cached, usage)))
+
+
+def _terminate_worker(signum, frame):
+    # Student programs run in their own sessions, and would survive the worker
+    runnable.kill_all()
+    os._exit(1)
+
+
+def _run_isolated(job, channel, log_level):
+    # Entry point of the worker process
+    signal.signal(signal.SIGTERM, _terminate_worker)
+    job.grade_writer = _ChannelWriter(channel)
+    if job.result_store:
+        job.result_store = _ChannelStore(job.result_store, channel)
+    job.start(log_level=log_level)
+    channel.send(('usage', job.usage_summary()))
+    channel.close()
+
+
+class _RunningJob():
+    def __init__(self, result, process, channel):
+        self.result = result
+        self.process = process
+        self.channel = channel
+        self.channel_open = True
+        self.started = time.monotonic()
+        self.records = []
+
+    def receive(self):
+        """
+        Read all pending feedback from the worker.
+        """
+        try:
+            while self.channel_open and self.channel.poll():
+                kind, data = self.channel.recv()
+                if kind == 'feedback':
+                    self.result.feedback.append(data)
+                elif kind == 'record':
+                    self.records.append(data)
+                elif kind == 'lookup':
+                    self.result.job.result_store.count_lookup(data)
+                else:
+                    self.result.usage = data
+        except (EOFError, OSError):
+            # Worker closed its end of the channel
+            self.channel_open = False
+
+
+class ValidationPool():
+    """
+    Runs many validation jobs concurrently, each one in its own worker process.
+
+    :meth:`Job.start` changes interpreter-wide state, such as `sys.path`, the
+    imported validator module and environment variables. Every job therefore
+    runs in a freshly forked process. Submission and validator files are downloaded
+    in parallel before the first worker starts, so that workers do not need the Moodle
+    connection, and no download threads are active when the workers are forked.
+    Validators are loaded once in the parent and inherited by the workers, unless
+    they set `RELOAD_PER_JOB`.
+    The feedback of the validator is sent to Moodle by the parent process, using
+    the `grade_writer` of the job if given.
+
+    Attributes:
+        workers (int):      Maximum number of jobs running at the same time.
+                            Defaults to the number of CPU cores.
+        timeout (float):    Maximum wall clock time for a single job in seconds,
+                            or None for no limit.
+        log_level (int):    The log level for the validation jobs.
+        downloads (int):    Maximum number of parallel downloads.
+    """
+    TIMEOUT_FEEDBACK = "The validation was cancelled, since it took too long."
+
+    def __init__(self, workers=None, timeout=600, log_level=logging.INFO, downloads=4):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.log_level = log_level
+        self.downloads = downloads
+        # Jobs and their connections are not picklable, so workers must be forked
+        self._context = multiprocessing.get_context('fork')
+
+    def _prepare(self, results):
+        """
+        Fetch the files of all jobs, and load their validators.
+        """
+        def fetch(result):
+            try:
+                result.job.validator_file.prefetch()
+                result.job.submission.prefetch()
+            except Exception as e:
+                logger.error("Fetching files for {0} failed: {1}".format(result.job.submission, e))
+                result.status = ValidationResult.CRASHED
+                result.error = str(e)
+                result.duration = 0
+
+        with ThreadPoolExecutor(max_workers=self.downloads) as executor:
+            list(executor.map(fetch, results))
+        loaded = set()
+        for result in results:
+            job = result.job
+            if result.status or job.validator_hash in loaded:
+                continue
+            loaded.add(job.validator_hash)
+            try:
+                # Loaded validator modules are inherited by the forked workers
+                script_name = os.path.join(job._prepare_validator_dir(), VALIDATOR_IMPORT_NAME + '.py')
+                if not _reloads_per_job(script_name):
+                    job.load_validator()
+            except Exception as e:
+                logger.debug("Validator could not be loaded in advance: {0}".format(e))
+
+    def _start(self, result):
+        job = result.job
+        receiver, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=_run_isolated,
+                                        args=(job, sender, self.log_level),
+                                        name='moodleteacher-validation',
+                                        daemon=True)
+        process.start()
+        sender.close()
+        logger.debug("Started validation of {0} in process {1}".format(job.submission, process.pid))
+        return _RunningJob(result, process, receiver)
+
+    def _finish(self, running, status=None, error=None):
+        result = running.result
+        if status == ValidationResult.TIMEOUT:
+            running.process.terminate()
+            running.process.join(5)
+            if running.process.is_alive():
+                running.process.kill()
+        running.process.join()
+        running.receive()
+        running.channel.close()
+        result.duration = time.monotonic() - running.started
+        result.exitcode = running.process.exitcode
+        if status:
+            result.status = status
+        elif result.exitcode == 0:
+            result.status = ValidationResult.FINISHED
+        else:
+            result.status = ValidationResult.CRASHED
+            error = "Worker process ended with exit code {0}".format(result.exitcode)
+        result.error = error
+        if result.status == ValidationResult.TIMEOUT and not result.feedback:
+            result.feedback.append(result.job.preamble + self.TIMEOUT_FEEDBACK)
+        delivered = True
+        for feedback in result.feedback:
+            try:
+                result.job._deliver_feedback(feedback)
+            except Exception as e:
+                logger.error("Sending feedback for {0} failed: {1}".format(result.job.submission, e))
+                result.error = str(e)
+                delivered = False
+        if delivered:
+            # Undelivered results must not be stored, so that they are sent again in the next run
+            for key, validator, outcome, feedback, duration, cached, usage in running.records:
+                result.job.result_store.record(key, validator, result.job.submission, outcome, feedback,
+                                               duration, cached, usage)
+        if error:
+            logger.warning("Validation of {0} failed: {1}".format(result.job.submission, error))
+        return result
+
+    def run(self, jobs):
+        """
+        Execute the given validation jobs, and wait until all of them are finished.
+
+        Returns:
+            list: A :class:`ValidationResult` for each job, in the order of the jobs.
+        """
+        results = [ValidationResult(job) for job in jobs]
+        # Forking while download threads are active is not safe, so all files are fetched before
+        self._prepare(results)
+        waiting = deque(result for result in results if not result.status)
+        running = []
+        while waiting or running:
+            while waiting and len(running) < self.workers:
+                running.append(self._start(waiting.popleft()))
+            wait_time = None
+            if self.timeout is not None:
+                now = time.monotonic()
+                wait_time = max(0, min(r.started + self.timeout - now for r in running))
+            handles = [r.channel for r in running if r.channel_open] + [r.process.sentinel for r in running]
+            multiprocessing.connection.wait(handles, wait_time)
+            for r in list(running):
+                r.receive()
+                if not r.process.is_alive():
+                    self._finish(r)
+                    running.remove(r)
+                elif self.timeout is not None and time.monotonic() - r.started >= self.timeout:
+                    self._finish(r, ValidationResult.TIMEOUT,
+                                 "Timeout after {0} seconds".format(self.timeout))
+                    running.remove(r)
+        return results